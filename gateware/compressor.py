@@ -0,0 +1,409 @@
+# Copyright (C) 2019 / LambdaConcept  / po@lambdaconcept.com
+from migen import *
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+
+from gateware.clocker import TuneClocker
+from gateware.ulpi import ulpi_cmd_description
+from gateware.iti import EVENT_NAK_RUN
+
+PID_IN  = 0x9
+PID_SOF = 0x5
+PID_NAK = 0xa
+
+
+class NAKCompressor(Module, AutoCSR):
+    """Replace the repeated IN / NAK exchanges of a polled endpoint by a
+    summary.
+
+    sink/source is the ULPI stream, delayed by latency cycles (a power of
+    two) so that an exchange can still be removed once its NAK is received:
+    the relative timing of the bytes is kept. The bytes leave through a
+    FIFO: while it is full the delay line stops, and so does sink. When
+    enable is cleared sink is connected straight to source.
+
+    The first IN / NAK exchange of a run is forwarded, and the following
+    ones with the same token bytes (address, endpoint, CRC) are removed,
+    RXCMDs between them included. SOF packets do not end a run, any other
+    packet does. Then if exchanges were removed, a summary is sent on
+    event_source (to ITICore.event_sink): EVENT_NAK_RUN, the number of
+    exchanges removed (16 bits) and the time since the end of the last one
+    in ticks (24 bits), least significant byte first. tick is the 60 MHz
+    enable of the shared ITITimebase, so that the summaries count the same
+    ticks as the records. The summary
+    events can be in the middle of the packet that ended the run. A summary
+    is only sent if event_source can buffer all its bytes, lost summaries
+    are counted.
+
+    An exchange is only removed if it lasts less than latency cycles.
+    """
+    def __init__(self, tick=None, latency=1024):
+        self.sink = sink = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.source = source = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.event_source = stream.Endpoint([("data", 8)])
+
+        self.enable = CSRStorage()
+        self.reset = CSR()
+        self.compressed = CSRStatus(32) # exchanges removed
+        self.runs = CSRStatus(32)       # summaries, lost ones included
+        self.lost = CSRStatus(32)       # summaries lost, event_source full
+
+        # # #
+
+        assert latency & (latency - 1) == 0
+        abits = log2_int(latency)
+
+        # delay line, written every step with the entry of sequence number
+        # seq, read back latency steps later. It steps on every cycle the
+        # output FIFO has room, a full FIFO stalls the whole pipeline. The
+        # FIFO absorbs the ITIPacker stalls of a time sync or summary burst
+        # (up to 7 event bytes) without stopping the delay line.
+        self.submodules.output = output = stream.SyncFIFO(ulpi_cmd_description(8, 1), 8)
+        step = Signal()
+        valid = Signal()
+        self.comb += [
+            step.eq(output.sink.ready),
+            valid.eq(sink.valid & step & self.enable.storage),
+            If(self.enable.storage,
+                sink.ready.eq(step),
+                output.source.connect(source),
+            ).Else(
+                sink.connect(source),
+            ),
+        ]
+
+        seq = Signal(16)
+        mem = Memory(11, latency)
+        wrport = mem.get_port(write_capable=True)
+        rdport = mem.get_port()
+        self.specials += mem, wrport, rdport
+
+        entry_valid = Signal()
+        entry_event = Signal()
+        entry_cmd = Signal()
+        entry_data = Signal(8)
+
+        self.comb += [
+            wrport.adr.eq(seq[:abits]),
+            wrport.we.eq(step),
+            wrport.dat_w.eq(Cat(entry_data, entry_cmd, entry_event, entry_valid)),
+            # read the next entry, or the current one again on a stall
+            rdport.adr.eq(seq[:abits] + step),
+        ]
+        self.sync += If(step, seq.eq(seq + 1))
+
+        # ranges of entries to remove, in order
+        self.submodules.ranges = ranges = stream.SyncFIFO([("start", 16), ("end", 16)], 4)
+        self.submodules.events = events = stream.SyncFIFO([("data", 8)], 8)
+        self.comb += events.source.connect(self.event_source)
+
+        rseq = Signal(16)
+        offset = Signal(16)
+        length = Signal(16)
+        drop = Signal()
+        dat = rdport.dat_r
+
+        # summaries are written whole to the event FIFO or not at all
+        event_entry = Signal()
+        in_summary = Signal()
+        room = Signal()
+        dropping = Signal()
+        self.comb += [
+            rseq.eq(seq - latency),
+            offset.eq(rseq - ranges.source.start),
+            length.eq(ranges.source.end - ranges.source.start),
+            drop.eq(ranges.source.valid & (offset <= length)),
+            ranges.source.ready.eq(step & ranges.source.valid & (rseq == ranges.source.end)),
+
+            output.sink.valid.eq(step & dat[10] & ~dat[9] & ~drop),
+            output.sink.cmd.eq(dat[8]),
+            output.sink.data.eq(dat[0:8]),
+            event_entry.eq(step & dat[10] & dat[9]),
+            room.eq(events.level <= events.depth - 6),
+            events.sink.valid.eq(event_entry & Mux(in_summary, ~dropping, room)),
+            events.sink.data.eq(dat[0:8]),
+            events.sink.last.eq(dat[8]),
+        ]
+        self.sync += [
+            If(event_entry,
+                If(~in_summary,
+                    dropping.eq(~room),
+                    If(~room,
+                        self.lost.status.eq(self.lost.status + 1),
+                    ),
+                ),
+                in_summary.eq(~dat[8]),
+            ),
+        ]
+
+        # packets
+        in_packet = Signal()
+        have_start = Signal()
+        rx_start = Signal(16)
+        packet_start = Signal(16)
+
+        pid = sink.data[0:4]
+        pid_valid = Signal()
+        data_byte = Signal()
+        pid_byte = Signal()
+        end_rxcmd = Signal()
+        is_in = Signal()
+        is_sof = Signal()
+        is_nak = Signal()
+        self.comb += [
+            packet_start.eq(Mux(have_start, rx_start, seq)),
+            pid_valid.eq((sink.data[4:8] ^ pid) == 0xf),
+            data_byte.eq(valid & ~sink.cmd),
+            pid_byte.eq(data_byte & ~in_packet),
+            end_rxcmd.eq(valid & sink.cmd & ~sink.data[4] & in_packet),
+            is_in.eq(pid_byte & pid_valid & (pid == PID_IN)),
+            is_sof.eq(pid_byte & pid_valid & (pid == PID_SOF)),
+            is_nak.eq(pid_byte & pid_valid & (pid == PID_NAK)),
+        ]
+        self.sync += [
+            If(valid,
+                If(sink.cmd,
+                    If(~sink.data[4],
+                        # RxActive cleared
+                        in_packet.eq(0),
+                        have_start.eq(0),
+                    ).Elif(~in_packet & ~have_start,
+                        rx_start.eq(seq),
+                        have_start.eq(1),
+                    ),
+                ).Elif(~in_packet,
+                    in_packet.eq(1),
+                    have_start.eq(0),
+                ),
+            ),
+        ]
+
+        # exchanges
+        exchange_start = Signal(16)
+        token = Signal(16)
+        token_count = Signal(2)
+        elapsed = Signal(16)
+        swallow = Signal()
+        new_run = Signal()
+        end_run = Signal()
+
+        run = Signal()
+        run_token = Signal(16)
+        count = Signal(16)
+        delay = Signal(24)
+
+        self.comb += [
+            elapsed.eq(seq - exchange_start),
+            ranges.sink.start.eq(exchange_start),
+            ranges.sink.end.eq(seq),
+            ranges.sink.valid.eq(swallow),
+        ]
+
+        self.submodules.fsm = fsm = FSM()
+        fsm.act("IDLE",
+            If(is_in,
+                NextValue(exchange_start, packet_start),
+                NextValue(token_count, 0),
+                NextState("TOKEN"),
+            ).Elif(pid_byte & ~is_sof,
+                end_run.eq(1),
+            ),
+        )
+        fsm.act("TOKEN",
+            If(data_byte,
+                NextValue(token, Cat(token[8:16], sink.data)),
+                If(token_count != 3,
+                    NextValue(token_count, token_count + 1),
+                ),
+            ).Elif(end_rxcmd,
+                If(token_count == 2,
+                    NextState("WAIT"),
+                ).Else(
+                    end_run.eq(1),
+                    NextState("IDLE"),
+                ),
+            ),
+        )
+        fsm.act("WAIT",
+            If(is_nak,
+                NextState("NAK"),
+            ).Elif(is_in,
+                # no response
+                end_run.eq(1),
+                NextValue(exchange_start, packet_start),
+                NextValue(token_count, 0),
+                NextState("TOKEN"),
+            ).Elif(pid_byte,
+                end_run.eq(1),
+                NextState("IDLE"),
+            ),
+        )
+        fsm.act("NAK",
+            If(data_byte,
+                end_run.eq(1),
+                NextState("IDLE"),
+            ).Elif(end_rxcmd,
+                If(run & (token == run_token) & (count != 2**16 - 1) &
+                   (elapsed < latency - 1) & ranges.sink.ready,
+                    swallow.eq(1),
+                ).Else(
+                    new_run.eq(1),
+                ),
+                NextState("IDLE"),
+            ),
+        )
+
+        # summaries, written to the delay line between the ULPI bytes
+        if tick is None:
+            self.submodules.tune = TuneClocker(int((60/100)*2**32)) # 60 MHz clock
+            tick = self.tune.en
+        summary = Signal(48)
+        summary_left = Signal(max=7)
+        self.comb += [
+            If(valid,
+                entry_valid.eq(1),
+                entry_cmd.eq(sink.cmd),
+                entry_data.eq(sink.data),
+            ).Elif(summary_left != 0,
+                entry_valid.eq(1),
+                entry_event.eq(1),
+                entry_cmd.eq(summary_left == 1), # last byte of the summary
+                entry_data.eq(summary[0:8]),
+            ),
+        ]
+        self.sync += [
+            If(step & ~valid & (summary_left != 0),
+                summary.eq(summary[8:]),
+                summary_left.eq(summary_left - 1),
+            ),
+            If(tick & (delay != 2**24 - 1),
+                delay.eq(delay + 1),
+            ),
+            If(swallow,
+                count.eq(count + 1),
+                delay.eq(0),
+                self.compressed.status.eq(self.compressed.status + 1),
+            ),
+            If(new_run | end_run,
+                If(run & (count != 0),
+                    summary.eq(Cat(C(EVENT_NAK_RUN, 8), count, delay)),
+                    summary_left.eq(6),
+                    self.runs.status.eq(self.runs.status + 1),
+                ),
+                run.eq(new_run),
+                run_token.eq(token),
+                count.eq(0),
+                delay.eq(0),
+            ),
+            If(self.reset.re,
+                self.compressed.status.eq(0),
+                self.runs.status.eq(0),
+                self.lost.status.eq(0),
+            ),
+        ]
+
+
+def tb_compressor(dut, exchanges, compressed, runs, lost=0, enable=1):
+    yield dut.enable.storage.eq(enable)
+    for exchange in exchanges:
+        for packet in exchange:
+            for cmd, data in packet:
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.cmd.eq(cmd)
+                yield dut.sink.data.eq(data)
+                yield
+                while not (yield dut.sink.ready):
+                    yield
+                # 60 MHz ULPI bytes in the 100 MHz domain
+                yield dut.sink.valid.eq(0)
+                yield
+            for i in range(8):
+                yield
+        for i in range(50):
+            yield
+    for i in range(200):
+        yield
+    print("compressed {} exchanges, {} runs, {} lost".format(
+        (yield dut.compressed.status), (yield dut.runs.status), (yield dut.lost.status)))
+    assert (yield dut.compressed.status) == compressed
+    assert (yield dut.runs.status) == runs
+    assert (yield dut.lost.status) == lost
+
+
+@passive
+def tb_monitor(dut, received, events, blocked=0, stalled=False):
+    cycle = 0
+    while True:
+        # events not accepted for the first blocked cycles
+        yield dut.event_source.ready.eq(cycle >= blocked)
+        # bytes accepted on one cycle out of 5 when stalled
+        yield dut.source.ready.eq(~stalled | (cycle % 5 == 0))
+        if (yield dut.source.valid) and (yield dut.source.ready):
+            received.append((cycle, (yield dut.source.cmd), (yield dut.source.data)))
+        if (yield dut.event_source.valid) and (yield dut.event_source.ready):
+            events.append((yield dut.event_source.data))
+            assert (yield dut.event_source.last) == (len(events) % 6 == 0)
+        cycle += 1
+        yield
+
+
+if __name__ == "__main__":
+    # RxActive RXCMD, packet bytes, end of packet RXCMD
+    def packet(*data):
+        return [(1, 0x10)] + [(0, d) for d in data] + [(1, 0x00)]
+
+    sof = packet(0xa5, 0x23, 0x41)
+    in_5_1 = packet(0x69, 0x85, 0x60)
+    in_3_1 = packet(0x69, 0x83, 0xe0)
+    nak = packet(0x5a)
+    data = packet(0x4b, 0x01, 0x02, 0x7e, 0x1e)
+    ack = packet(0xd2)
+    exchanges = [[sof]] + [[in_5_1, nak]]*4 + [[sof]] + [[in_5_1, nak]]*3 + \
+                [[in_5_1, data, ack], [in_3_1, nak], [in_3_1, data, ack]]
+    received = []
+    events = []
+
+    dut = NAKCompressor(latency=64)
+    run_simulation(dut, [tb_compressor(dut, exchanges, 6, 1), tb_monitor(dut, received, events)],
+        vcd_name="test/nak_compressor.vcd")
+    # only the first exchange of the run is kept
+    kept = [0, 1, 5, 9, 10, 11]
+    flatten = lambda exchanges: [byte for exchange in exchanges for packet in exchange for byte in packet]
+    expected = flatten(exchanges[i] for i in kept)
+    assert [(cmd, data) for cycle, cmd, data in received] == expected, received
+    # relative timing kept, within the SOFs
+    sof_cycles = [cycle for cycle, cmd, data in received if (cmd, data) == (0, 0xa5)]
+    assert sof_cycles[1] - sof_cycles[0] == 2*len(flatten(exchanges[0:5])) + 8*9 + 50*5
+    # summary of the 6 exchanges removed, about 50 cycles after the last one
+    assert events[:3] == [EVENT_NAK_RUN, 6, 0] and len(events) == 6, events
+    delay = events[3] | (events[4] << 8) | (events[5] << 16)
+    assert 30 < delay < 60, delay
+
+    # 2 runs while event_source is blocked: the event FIFO only has room for
+    # the first summary, the second one is dropped whole
+    exchanges = [[in_5_1, nak]]*3 + [[in_3_1, nak]]*3 + [[in_3_1, data, ack]]
+    received = []
+    events = []
+    dut = NAKCompressor(latency=64)
+    run_simulation(dut, [tb_compressor(dut, exchanges, 4, 2, lost=1), tb_monitor(dut, received, events, 700)],
+        vcd_name="test/nak_compressor_lost.vcd")
+    assert events[:3] == [EVENT_NAK_RUN, 2, 0] and len(events) == 6, events
+
+    # source stalled: sink is stalled too, no byte is lost
+    exchanges = [[sof]] + [[in_5_1, nak]]*4 + [[in_5_1, data, ack]]*2 + [[in_3_1, nak]]*3 + [[in_3_1, data, ack]]
+    received = []
+    events = []
+    dut = NAKCompressor(latency=64)
+    run_simulation(dut, [tb_compressor(dut, exchanges, 5, 2), tb_monitor(dut, received, events, stalled=True)],
+        vcd_name="test/nak_compressor_stalled.vcd")
+    expected = flatten(exchanges[i] for i in [0, 1, 5, 6, 7, 10])
+    assert [(cmd, data) for cycle, cmd, data in received] == expected, received
+    assert events[:3] == [EVENT_NAK_RUN, 3, 0] and events[6:9] == [EVENT_NAK_RUN, 2, 0], events
+
+    # disabled: sink connected to source
+    received = []
+    dut = NAKCompressor(latency=64)
+    run_simulation(dut, [tb_compressor(dut, exchanges, 0, 0, enable=0), tb_monitor(dut, received, [], stalled=True)],
+        vcd_name="test/nak_compressor_disabled.vcd")
+    assert [(cmd, data) for cycle, cmd, data in received] == flatten(exchanges), received
@@ -354,6 +354,11 @@ class LiteDRAMFIFO(Module):
 
         # ctrl counts blocks in native width
         self.submodules.ctrl = _LiteDRAMFIFOCtrl(base, ctrl_depth, read_threshold, write_threshold)
+
+        # number of words stored in DRAM
+        self.level = Signal(max=ctrl_depth*ctrl_ratio + 1)
+        self.comb += self.level.eq(self.ctrl.level*ctrl_ratio)
+
         self.submodules.writer = _LiteDRAMFIFOWriter(write_port, self.ctrl)
         self.submodules.reader = _LiteDRAMFIFOReader(read_port, self.ctrl)
 
@@ -265,12 +265,93 @@ class EtherboneRecordPacketizer(Packetizer):
             etherbone_record_header)
 
 
-class EtherboneRecordDepacketizer(Depacketizer):
+def eth_etherbone_reply_description():
+    payload_layout = [
+        ("length",  32),
+        ("records", 16)
+    ]
+    return EndpointDescription(payload_layout)
+
+
+class EtherboneRecordDepacketizer(Module):
+    """Split a packet into its chain of records.
+
+    Each record is a header word followed by its payload: base address and
+    wcount writes if wcount, base return address and rcount reads if rcount.
+    The word following a record's payload is the header of the next record,
+    until the end of the packet.
+
+    Once the last word of a packet is received, the length and number of
+    records of its reply are pushed to reply (if it contains reads).
+    """
     def __init__(self):
-        Depacketizer.__init__(self,
-            eth_etherbone_packet_user_description(32),
-            eth_etherbone_record_description(32),
-            etherbone_record_header)
+        self.sink = sink = stream.Endpoint(eth_etherbone_packet_user_description(32))
+        self.source = source = stream.Endpoint(eth_etherbone_record_description(32))
+        self.reply = reply = stream.Endpoint(eth_etherbone_reply_description())
+
+        # # #
+
+        header = Signal(32)
+        new = Record(etherbone_record_header.get_layout())
+        current = Record(etherbone_record_header.get_layout())
+        self.comb += [
+            etherbone_record_header.decode(sink.data, new),
+            etherbone_record_header.decode(header, current)
+        ]
+        for name, width in etherbone_record_header.get_layout():
+            self.comb += getattr(source, name).eq(getattr(current, name))
+
+        words = Signal(max=2*(2**8 + 1) + 1)
+        self.comb += words.eq(Mux(new.wcount != 0, new.wcount + 1, 0) +
+                              Mux(new.rcount != 0, new.rcount + 1, 0))
+        counter = Signal.like(words)
+
+        reply_length = Signal(32)
+        reply_records = Signal(16)
+
+        self.submodules.fsm = fsm = FSM(reset_state="HEADER")
+        fsm.act("HEADER",
+            sink.ready.eq(1),
+            If(sink.valid,
+                NextValue(header, sink.data),
+                NextValue(counter, words),
+                If(new.rcount != 0,
+                    NextValue(reply_length, reply_length +
+                              etherbone_record_header.length + 4*(new.rcount + 1)),
+                    NextValue(reply_records, reply_records + 1)
+                ),
+                If(sink.last,
+                    NextState("REPLY")
+                ).Elif(words != 0,
+                    NextState("PAYLOAD")
+                )
+            )
+        )
+        fsm.act("PAYLOAD",
+            source.valid.eq(sink.valid),
+            source.last.eq(counter == 1),
+            source.data.eq(sink.data),
+            source.error.eq(sink.error),
+            sink.ready.eq(source.ready),
+            If(sink.valid & sink.ready,
+                NextValue(counter, counter - 1),
+                If(sink.last,
+                    NextState("REPLY")
+                ).Elif(counter == 1,
+                    NextState("HEADER")
+                )
+            )
+        )
+        fsm.act("REPLY",
+            reply.valid.eq(reply_records != 0),
+            reply.length.eq(reply_length),
+            reply.records.eq(reply_records),
+            If(reply.ready | (reply_records == 0),
+                NextValue(reply_length, 0),
+                NextValue(reply_records, 0),
+                NextState("HEADER")
+            )
+        )
 
 
 class EtherboneRecordReceiver(Module):
@@ -334,6 +415,7 @@ class EtherboneRecordReceiver(Module):
             )
         )
         fsm.act("RECEIVE_BASE_RET_ADDR",
+            fifo.source.ready.eq(1),
             counter_reset.eq(1),
             If(fifo.source.valid,
                 base_addr_update.eq(1),
@@ -407,16 +489,19 @@ class EtherboneRecordSender(Module):
 
 
 class EtherboneRecord(Module):
-    # Limitation: For simplicity we only support 1 record per packet
-    def __init__(self, endianness="big"):
+    # A packet can chain several records, the replies to its reads are
+    # aggregated in a single packet. This packet is sent once the whole
+    # request has been received: to avoid stalling, the payloads of the
+    # records of a packet must fit in the receiver buffer (buffer_depth words).
+    def __init__(self, endianness="big", buffer_depth=256):
         self.sink = sink = stream.Endpoint(eth_etherbone_packet_user_description(32))
         self.source = source = stream.Endpoint(eth_etherbone_packet_user_description(32))
 
         # # #
 
-        # receive record, decode it and generate mmap stream
+        # receive records, decode them and generate mmap stream
         self.submodules.depacketizer = depacketizer = EtherboneRecordDepacketizer()
-        self.submodules.receiver = receiver = EtherboneRecordReceiver()
+        self.submodules.receiver = receiver = EtherboneRecordReceiver(buffer_depth)
         self.comb += [
             sink.connect(depacketizer.sink),
             depacketizer.source.connect(receiver.sink)
@@ -425,88 +510,128 @@ class EtherboneRecord(Module):
             self.comb += receiver.sink.data.eq(reverse_bytes(depacketizer.source.data))
 
         # receive mmap stream, encode it and send records
-        self.submodules.sender = sender = EtherboneRecordSender()
+        self.submodules.sender = sender = EtherboneRecordSender(buffer_depth)
         self.submodules.packetizer = packetizer = EtherboneRecordPacketizer()
-        self.comb += [
-            sender.source.connect(packetizer.sink),
-            packetizer.source.connect(source),
-            source.length.eq(etherbone_record_header.length +
-                             (sender.source.wcount != 0)*4 + sender.source.wcount*4 +
-                             (sender.source.rcount != 0)*4 + sender.source.rcount*4)
-        ]
+        self.comb += sender.source.connect(packetizer.sink)
         if endianness is "big":
             self.comb += packetizer.sink.data.eq(reverse_bytes(sender.source.data))
 
+        # aggregate the records replied to a packet in a single packet
+        self.submodules.replies = replies = stream.SyncFIFO(eth_etherbone_reply_description(), 4)
+        self.comb += depacketizer.reply.connect(replies.sink)
+
+        records = Signal(16)
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(replies.source.valid,
+                NextValue(records, replies.source.records),
+                NextState("SEND")
+            )
+        )
+        fsm.act("SEND",
+            packetizer.source.connect(source),
+            source.length.eq(replies.source.length),
+            source.last.eq(packetizer.source.last & (records == 1)),
+            If(packetizer.source.valid & packetizer.source.ready & packetizer.source.last,
+                NextValue(records, records - 1),
+                If(records == 1,
+                    replies.source.ready.eq(1),
+                    NextState("IDLE")
+                )
+            )
+        )
 
 
 # etherbone wishbone
 
 class EtherboneWishboneMaster(Module):
-    def __init__(self):
+    """Pipelined wishbone master.
+
+    The next access is issued as soon as the current one is acked: read
+    datas are pushed to a buffer streamed out to the sender while the
+    following reads are performed. The next access being visible on the
+    sink, consecutive addresses are signaled as incrementing bursts (cti)
+    to the slaves supporting them, others seeing classic cycles.
+    """
+    def __init__(self, buffer_depth=16):
         self.sink = sink = stream.Endpoint(eth_etherbone_mmap_description(32))
         self.source = source = stream.Endpoint(eth_etherbone_mmap_description(32))
         self.bus = bus = wishbone.Interface()
 
         # # #
 
-        data = Signal(32)
-        data_update = Signal()
-        self.sync += If(data_update, data.eq(bus.dat_r))
+        self.submodules.buf = buf = stream.SyncFIFO(eth_etherbone_mmap_description(32), buffer_depth)
+        self.comb += buf.source.connect(source)
 
-        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
-        fsm.act("IDLE",
-            sink.ready.eq(1),
-            If(sink.valid,
-                sink.ready.eq(0),
-                If(sink.we,
-                    NextState("WRITE_DATA")
-                ).Else(
-                    NextState("READ_DATA")
-                )
-            )
-        )
-        fsm.act("WRITE_DATA",
-            bus.adr.eq(sink.addr),
-            bus.dat_w.eq(sink.data),
-            bus.sel.eq(sink.be),
-            bus.stb.eq(sink.valid),
-            bus.we.eq(1),
-            bus.cyc.eq(1),
-            If(bus.stb & bus.ack,
-                sink.ready.eq(1),
-                If(sink.last,
-                    NextState("IDLE")
-                )
-            )
-        )
-        fsm.act("READ_DATA",
-            bus.adr.eq(sink.addr),
-            bus.sel.eq(sink.be),
-            bus.stb.eq(sink.valid),
-            bus.cyc.eq(1),
-            If(bus.stb & bus.ack,
-                data_update.eq(1),
-                NextState("SEND_DATA")
+        # access performed on the bus, the sink holding the next one
+        current = stream.Endpoint(eth_etherbone_mmap_description(32))
+        load = Signal()
+        self.comb += [
+            load.eq(~current.valid | current.ready),
+            sink.ready.eq(load)
+        ]
+        self.sync += \
+            If(load,
+                current.valid.eq(sink.valid),
+                current.last.eq(sink.last),
+                current.payload.eq(sink.payload),
+                current.param.eq(sink.param)
             )
-        )
-        fsm.act("SEND_DATA",
-            source.valid.eq(sink.valid),
-            source.last.eq(sink.last),
-            source.base_addr.eq(sink.base_addr),
-            source.addr.eq(sink.addr),
-            source.count.eq(sink.count),
-            source.be.eq(sink.be),
-            source.we.eq(1),
-            source.data.eq(data),
-            If(source.valid & source.ready,
-                sink.ready.eq(1),
-                If(source.last,
-                    NextState("IDLE")
-                ).Else(
-                    NextState("READ_DATA")
-                )
+
+        # writes always complete, reads need room to store their data
+        access = Signal()
+        self.comb += [
+            access.eq(current.valid & (current.we | buf.sink.ready)),
+            bus.adr.eq(current.addr),
+            bus.dat_w.eq(current.data),
+            bus.sel.eq(current.be),
+            bus.we.eq(current.we),
+            bus.cyc.eq(access),
+            bus.stb.eq(access),
+            current.ready.eq(access & bus.ack)
+        ]
+
+        # incrementing bursts, decided when the access is issued: the sink
+        # can present the next access while the slave inserts wait states,
+        # cti must not change before the ack
+        burst = Signal()
+        burst_next = Signal()
+        burst_issued = Signal()
+        issued = Signal()
+        bursting = Signal()
+        self.comb += [
+            burst_next.eq(sink.valid &
+                          (sink.we == current.we) &
+                          (sink.addr == current.addr + 1)),
+            burst.eq(Mux(issued, burst_issued, burst_next)),
+            If(burst,
+                bus.cti.eq(0b010)
+            ).Elif(bursting,
+                bus.cti.eq(0b111)
             )
-        )
+        ]
+        self.sync += [
+            If(access & ~bus.ack,
+                issued.eq(1),
+                burst_issued.eq(burst)
+            ).Else(
+                issued.eq(0)
+            ),
+            If(access & bus.ack, bursting.eq(burst))
+        ]
+
+        # read datas
+        self.comb += [
+            buf.sink.valid.eq(access & bus.ack & ~current.we),
+            buf.sink.last.eq(current.last),
+            buf.sink.base_addr.eq(current.base_addr),
+            buf.sink.addr.eq(current.addr),
+            buf.sink.count.eq(current.count),
+            buf.sink.be.eq(current.be),
+            buf.sink.we.eq(1),
+            buf.sink.data.eq(bus.dat_r)
+        ]
 
 
 # etherbone
@@ -533,3 +658,86 @@ class Etherbone(Module):
             record.receiver.source.connect(master.sink),
             master.source.connect(record.sender.sink)
         ]
+
+
+def tb_master(dut, accesses):
+    for i, (we, addr, data, gap) in enumerate(accesses):
+        yield dut.sink.valid.eq(1)
+        yield dut.sink.last.eq(i == len(accesses) - 1)
+        yield dut.sink.we.eq(we)
+        yield dut.sink.addr.eq(addr)
+        yield dut.sink.data.eq(data)
+        yield dut.sink.be.eq(0xf)
+        yield
+        while not (yield dut.sink.ready):
+            yield
+        # the next access appears while the current one waits for its ack
+        yield dut.sink.valid.eq(0)
+        for j in range(gap):
+            yield
+    yield dut.sink.valid.eq(0)
+    for i in range(64):
+        yield
+
+
+@passive
+def tb_slave(dut, mem, beats):
+    bus = dut.bus
+    while True:
+        if (yield bus.cyc) and (yield bus.stb):
+            adr = (yield bus.adr)
+            we = (yield bus.we)
+            cti = (yield bus.cti)
+            # wait states
+            for i in range(adr % 3):
+                yield
+                assert (yield bus.cyc) and (yield bus.stb)
+                assert (yield bus.adr) == adr and (yield bus.cti) == cti, "beat changed before ack"
+            if we:
+                mem[adr] = (yield bus.dat_w)
+            else:
+                yield bus.dat_r.eq(mem[adr])
+            yield bus.ack.eq(1)
+            yield
+            yield bus.ack.eq(0)
+            yield
+            beats.append((adr, we, cti))
+        else:
+            yield
+
+
+@passive
+def tb_reads(dut, received):
+    yield dut.source.ready.eq(1)
+    while True:
+        if (yield dut.source.valid):
+            received.append(((yield dut.source.addr), (yield dut.source.data)))
+        yield
+
+
+if __name__ == "__main__":
+    import random
+    random.seed(0)
+    # consecutive and non consecutive writes then reads, with and without gaps
+    # between the accesses
+    addrs = [0, 1, 2, 3, 8, 9, 20, 21, 22, 5]
+    accesses = [(1, a, random.randrange(2**32), random.choice([0, 0, 1, 3])) for a in addrs]
+    accesses += [(0, a, 0, random.choice([0, 0, 1, 3])) for a in addrs + addrs[::-1]]
+    mem = {}
+    beats = []
+    received = []
+
+    dut = EtherboneWishboneMaster()
+    run_simulation(dut, [tb_master(dut, accesses), tb_slave(dut, mem, beats), tb_reads(dut, received)],
+        vcd_name="test/etherbone_master.vcd")
+    assert [(adr, we) for adr, we, cti in beats] == [(addr, we) for we, addr, data, gap in accesses]
+    assert mem == {addr: data for we, addr, data, gap in accesses if we}
+    assert received == [(a, mem[a]) for a in addrs + addrs[::-1]]
+    # a burst beat is followed by the next address, the burst ended by 0b111
+    for (adr, we, cti), (next_adr, next_we, next_cti) in zip(beats, beats[1:]):
+        if cti == 0b010:
+            assert (next_adr, next_we) == (adr + 1, we)
+            assert next_cti in (0b010, 0b111)
+    bursts = sum(cti == 0b010 for adr, we, cti in beats)
+    print("{} beats, {} in bursts".format(len(beats), bursts))
+    assert bursts > 0
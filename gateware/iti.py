@@ -6,6 +6,7 @@
 from migen import *
 
 from litex.soc.interconnect import stream
+from litex.soc.interconnect.stream_packet import Arbiter
 from litex.soc.interconnect.csr import *
 
 from gateware.clocker import TuneClocker
@@ -22,42 +23,68 @@ PAYLOAD_RXCMD = 3
 
 EVENT_START     = 0xe0
 EVENT_STOP      = 0xf1
+EVENT_TRIGGER   = 0xe2 # not an ITI1480A event
+EVENT_NAK_RUN   = 0xe3 # not an ITI1480A event, followed by 5 bytes of summary
+EVENT_TIME_SYNC = 0xe4 # not an ITI1480A event, followed by 6 bytes of time
 
 
-class ITITime(Module, AutoCSR):
+class ITITimebase(Module, AutoCSR):
+    """Free running 60 MHz time shared by the ITI cores."""
     def __init__(self):
+        self.latch = CSR()
+        self.latched = CSRStatus(48)
+
+        self.tick = Signal()        # output, 60 MHz enable
+        self.time = Signal(48)      # output, ticks since reset
+
+        # # #
+
+        self.submodules.tune = TuneClocker(int((60/100)*2**32)) # 60 MHz clock
+
+        self.comb += self.tick.eq(self.tune.en)
+        self.sync += [
+            If(self.tick,
+                self.time.eq(self.time + 1),
+            ),
+            If(self.latch.re,
+                self.latched.status.eq(self.time),
+            ),
+        ]
+
+
+class ITITime(Module, AutoCSR):
+    def __init__(self, tick=None):
         self.enable = CSRStorage()
 
-        self.diff = Signal(28)      # output, time increment
+        self.diff = Signal(29)      # output, time increment
         self.len = Signal(2)        # output, time increment length
         self.next = Signal()        # input, set 1 to reset time increment
 
         self.overflow = Signal()    # output, 1 indicates increment overflow
-        self.clear = Signal()       # input, set 1 to clear overflow
 
         # # #
 
-        self.submodules.tune = TuneClocker(int((60/100)*2**32)) # 60 MHz clock
+        if tick is None:
+            self.submodules.tune = TuneClocker(int((60/100)*2**32)) # 60 MHz clock
+            tick = self.tune.en
 
+        # every tick is counted in exactly one increment, the increments of a
+        # stream adding up to the ticks of the shared timebase. The count goes
+        # on past the max value while the overflow record waits to be sent.
+        self.comb += self.overflow.eq(self.diff >= (2**28) - 1)
         self.sync += [
             If(~self.enable.storage,
                 self.diff.eq(0),
-                self.overflow.eq(0),
             ).Else(
                 If(self.next,
-                    self.diff.eq(0),
-                    self.overflow.eq(0),
-                ).Else(
-                    If(self.tune.en,
-                        self.diff.eq(self.diff + 1),
-                    ),
-                    If(self.diff == (2**28) - 1,
-                        # max value reached, trigger overflow
-                        self.overflow.eq(1),
-                    ).Elif(self.clear,
-                        # acknowledge overflow, clear it
-                        self.overflow.eq(0),
+                    If(self.overflow,
+                        # the overflow record holds the max value, keep the rest
+                        self.diff.eq(self.diff - ((2**28) - 1) + tick),
+                    ).Else(
+                        self.diff.eq(tick),
                     ),
+                ).Elif(tick & (self.diff != (2**29) - 1),
+                    self.diff.eq(self.diff + 1),
                 ),
             ),
         ]
@@ -77,6 +104,12 @@ class ITITime(Module, AutoCSR):
 
 
 class ITIEvent(Module, AutoCSR):
+    """Event records, one byte at a time.
+
+    The bytes of an event received on sink (ending with last) are sent in
+    sequence. CSR writes and external events are kept pending until the
+    previous byte is sent, and sent between the sequences.
+    """
     def __init__(self):
         self.event = CSR(8)
 
@@ -84,26 +117,53 @@ class ITIEvent(Module, AutoCSR):
         self.new = new = Signal()
         self.ack = ack = Signal()
 
+        self.external = Signal()                        # input, set 1 to send external_data
+        self.external_data = Signal.like(self.event.r)  # input
+
+        self.sink = sink = stream.Endpoint([("data", 8)]) # events from the gateware
+
         # # #
 
+        event_pending = Signal()
+        event_data = Signal.like(self.event.r)
+        external_pending = Signal()
+        in_sequence = Signal()
+
+        self.comb += sink.ready.eq(~new & (in_sequence | (~event_pending & ~external_pending)))
         self.sync += [
-            If(self.event.re,
-                data.eq(self.event.r),
+            If(sink.valid & sink.ready,
+                data.eq(sink.data),
+                new.eq(1),
+                in_sequence.eq(~sink.last),
+            ).Elif(~new & ~in_sequence & event_pending,
+                data.eq(event_data),
+                new.eq(1),
+                event_pending.eq(0),
+            ).Elif(~new & ~in_sequence & external_pending,
+                data.eq(self.external_data),
                 new.eq(1),
-            ).Elif(~self.event.re & ack,
+                external_pending.eq(0),
+            ).Elif(ack,
                 new.eq(0),
-            )
+            ),
+            If(self.event.re,
+                event_data.eq(self.event.r),
+                event_pending.eq(1),
+            ),
+            If(self.external,
+                external_pending.eq(1),
+            ),
         ]
 
 
 class ITIPacker(Module, AutoCSR):
-    def __init__(self):
+    def __init__(self, tick=None):
         self.sink = sink = stream.Endpoint([('data', 8), ('cmd', 1)])
         self.source = source = stream.Endpoint([("data", 40), ("len", 2)])
 
         # # #
 
-        self.submodules.time = ITITime()
+        self.submodules.time = ITITime(tick)
         self.submodules.ev = ITIEvent()
 
         payload_type = Signal(2)
@@ -123,7 +183,7 @@ class ITIPacker(Module, AutoCSR):
                 # stream out
                 source.valid.eq(1),
                 If(source.ready,
-                    self.time.clear.eq(1),
+                    self.time.next.eq(1),
                 ),
 
             ).Elif(self.ev.new,
@@ -251,21 +311,98 @@ class ITIPattern(Module):
         )
 
 
+class ITISync(Module, AutoCSR):
+    """Send the time of the timebase every period ticks (0 to disable).
+
+    An EVENT_TIME_SYNC event is followed by 6 events with the time of its
+    record, least significant byte first, letting the host convert the
+    timestamps of a stream to the time shared by all the channels.
+    """
+    def __init__(self, timebase):
+        self.source = source = stream.Endpoint([("data", 8)])
+
+        self.sent = Signal()        # input, an event record is sent
+
+        self.period = CSRStorage(32, reset=60000) # 1 ms
+
+        # # #
+
+        count = Signal(32)
+        time = Signal(48)
+        index = Signal(max=6)
+
+        self.submodules.fsm = fsm = FSM()
+        fsm.act("IDLE",
+            If(timebase.tick,
+                NextValue(count, count + 1),
+            ),
+            If((self.period.storage != 0) & (count >= self.period.storage),
+                NextValue(count, 0),
+                NextState("EVENT"),
+            ),
+        )
+        fsm.act("EVENT",
+            source.valid.eq(1),
+            source.data.eq(EVENT_TIME_SYNC),
+            If(source.ready,
+                NextState("SENT"),
+            ),
+        )
+        fsm.act("SENT",
+            # the first event record sent is the EVENT_TIME_SYNC (ITIEvent
+            # does not interrupt sequences)
+            If(self.sent,
+                NextValue(time, timebase.time),
+                NextValue(index, 0),
+                NextState("TIME"),
+            ),
+        )
+        fsm.act("TIME",
+            source.valid.eq(1),
+            source.data.eq(time[0:8]),
+            source.last.eq(index == 5),
+            If(source.ready,
+                NextValue(time, time[8:]),
+                NextValue(index, index + 1),
+                If(index == 5,
+                    NextState("IDLE"),
+                ),
+            ),
+        )
+
+
 @ResetInserter()
 class ITICore(Module, AutoCSR):
-    def __init__(self):
+    def __init__(self, timebase=None):
         self.sink = sink = stream.Endpoint([('data', 8), ('cmd', 1)])
         self.source = source = stream.Endpoint([("data", 40), ("len", 2)])
 
         self.start_pattern = CSR()
 
+        self.trigger = Signal() # input, set 1 to send an EVENT_TRIGGER
+
+        # events, the bytes of an event sent together ending with last
+        self.event_sink = stream.Endpoint([("data", 8)])
+
         # # #
 
         self.submodules.pattern = ITIPattern(0xe00050, 3, 4)
-        self.submodules.packer = ITIPacker()
+
+        if timebase is None:
+            self.submodules.packer = ITIPacker()
+            self.comb += self.event_sink.connect(self.packer.ev.sink)
+        else:
+            # time shared with the other cores, sent periodically
+            self.submodules.packer = ITIPacker(timebase.tick)
+            self.submodules.time_sync = ITISync(timebase)
+            self.submodules.arbiter = Arbiter([self.time_sync.source, self.event_sink],
+                                              self.packer.ev.sink)
+            self.comb += self.time_sync.sent.eq(self.packer.ev.ack)
 
         self.comb += [
             self.pattern.start.eq(self.start_pattern.re),
+            self.packer.ev.external.eq(self.trigger),
+            self.packer.ev.external_data.eq(EVENT_TRIGGER),
 
             # Mux sources with priority to pattern generator
             If(self.pattern.source.valid,
@@ -519,12 +656,140 @@ def tb_time(dut):
     yield dut.diff.eq(2**28 - 10)
     for i in range(2**16):
         if (yield dut.overflow):
-            yield dut.clear.eq(1)
+            yield dut.next.eq(1)
         else:
-            yield dut.clear.eq(0)
+            yield dut.next.eq(0)
+        yield
+
+
+def tb_timebase(dut, core, period, sent):
+    yield core.packer.time.enable.storage.eq(1)
+    yield core.time_sync.period.storage.eq(40)
+    yield core.source.ready.eq(1)
+    marker = False
+    for i in range(2000):
+        yield core.sink.valid.eq(i % period == 0)
+        yield core.sink.data.eq(i & 0xff)
+        # a trigger when an EVENT_TIME_SYNC is sent, a CSR event the cycle after
+        was_marker = marker
+        marker = (yield core.time_sync.source.valid) and \
+                 (yield core.time_sync.source.data) == EVENT_TIME_SYNC
+        yield core.trigger.eq(marker and not was_marker)
+        yield core.packer.ev.event.re.eq(was_marker and not marker)
+        yield core.packer.ev.event.r.eq(0x55)
+        if marker and not was_marker:
+            sent += [EVENT_TRIGGER, 0x55]
+        yield
+    yield core.trigger.eq(0)
+    yield core.packer.ev.event.re.eq(0)
+    for i in range(100):
         yield
 
 
+def tb_overflow(dut, start, stall):
+    """Jump the time of the timebase and of the cores to just before an
+    increment overflow, the records stalled until it is past."""
+    cores = [dut.core0, dut.core1]
+    for i in range(start):
+        yield
+    # between ticks and records, so that the jump replaces no update
+    while True:
+        busy = (yield dut.timebase.tick)
+        for core in cores:
+            busy |= (yield core.packer.time.next)
+        if not busy:
+            break
+        yield
+    delta = 2**28 - 40
+    yield dut.timebase.time.eq(dut.timebase.time + delta)
+    for core in cores:
+        yield core.packer.time.diff.eq(core.packer.time.diff + delta)
+        yield core.source.ready.eq(0)
+    for i in range(stall):
+        yield
+    for core in cores:
+        yield core.source.ready.eq(1)
+
+
+@passive
+def tb_summaries(dut, core, sent):
+    while True:
+        for i, data in enumerate([EVENT_NAK_RUN, 1, 2, 3, 4, 5]):
+            yield core.event_sink.valid.eq(1)
+            yield core.event_sink.data.eq(data)
+            yield core.event_sink.last.eq(i == 5)
+            yield
+            while not (yield core.event_sink.ready):
+                yield
+        sent.append(EVENT_NAK_RUN)
+        yield core.event_sink.valid.eq(0)
+        for i in range(13):
+            yield
+
+
+@passive
+def tb_records(dut, core, words):
+    while True:
+        if (yield core.source.valid) and (yield core.source.ready):
+            words.append(((yield core.source.data), (yield core.source.len),
+                          (yield dut.timebase.time)))
+        yield
+
+
+def check_timebase(words):
+    """Check the time of the records rebuilt from the EVENT_TIME_SYNCs
+    against the timebase when they were sent, return the number of syncs
+    and overflows and the other events (NAK run summaries whole)."""
+    ts = 0
+    sync = None
+    syncs = 0
+    overflows = 0
+    offsets = set()
+    records = []
+    events = []
+    summary = None
+    for data, length, sent in words:
+        h = data & 0xff
+        n = (h >> 4) & 3
+        ts += (h & 0xf) | (((data >> 8) & (2**(8*n) - 1)) << 4)
+        payload_type = h >> 6
+        payload = (data >> (8*(n + 1))) & 0xff
+        if payload_type == PAYLOAD_NONE:
+            # the time of the max value, the record can be sent later
+            overflows += 1
+        elif payload_type == PAYLOAD_EVENT and (sync is not None or payload == EVENT_TIME_SYNC):
+            if sync is None:
+                sync = [ts]
+            else:
+                sync.append(payload)
+                if len(sync) == 7:
+                    offsets.add(int.from_bytes(bytes(sync[1:]), "little") - sync[0])
+                    syncs += 1
+                    sync = None
+        else:
+            records.append((ts, sent))
+            if payload_type == PAYLOAD_EVENT:
+                if summary is not None or payload == EVENT_NAK_RUN:
+                    summary = (summary or []) + [payload]
+                    if len(summary) == 6:
+                        assert summary == [EVENT_NAK_RUN, 1, 2, 3, 4, 5], summary
+                        events.append(EVENT_NAK_RUN)
+                        summary = None
+                else:
+                    events.append(payload)
+    assert len(offsets) == 1, offsets
+    offset = offsets.pop()
+    assert all(ts + offset == sent for ts, sent in records)
+    return syncs, overflows, events
+
+
+class TimebaseTestBench(Module):
+    def __init__(self):
+        self.submodules.timebase = ITITimebase()
+        self.submodules.core0 = ITICore(self.timebase)
+        self.submodules.core1 = ITICore(self.timebase)
+
+
 class TopTestBench(Module):
     def __init__(self):
         self.submodules.packer = ITIPacker()
@@ -543,3 +808,19 @@ if __name__ == "__main__":
 
     dut = TopTestBench()
     run_simulation(dut, tb_conv(dut), vcd_name="test/conv4032.vcd")
+
+    # two cores on the same timebase, records sent at different times,
+    # other events sent with the syncs, an increment overflow while the
+    # records are stalled
+    dut = TimebaseTestBench()
+    words0, words1 = [], []
+    sent0, sent1 = [], []
+    run_simulation(dut, [tb_timebase(dut, dut.core0, 7, sent0), tb_timebase(dut, dut.core1, 11, sent1),
+                         tb_overflow(dut, 1000, 100), tb_summaries(dut, dut.core0, sent0),
+                         tb_records(dut, dut.core0, words0), tb_records(dut, dut.core1, words1)],
+        vcd_name="test/iti_timebase.vcd")
+    for words, sent in [(words0, sent0), (words1, sent1)]:
+        syncs, overflows, events = check_timebase(words)
+        assert syncs > 10
+        assert overflows == 1
+        assert sorted(events) == sorted(sent), (events, sent)
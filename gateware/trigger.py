@@ -0,0 +1,318 @@
+# Copyright (C) 2019 / LambdaConcept  / po@lambdaconcept.com
+from migen import *
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+
+from gateware.ulpi import ulpi_cmd_description
+
+
+# trigger conditions
+CONDITION_PACKET    = 0b001 # packet with a PID of pid_mask
+CONDITION_PATTERN   = 0b010 # ... and its first bytes matching pattern
+CONDITION_LINESTATE = 0b100 # linestate held for linestate_duration cycles
+
+# trigger states
+STATE_FORWARD   = 0 # not armed, everything forwarded
+STATE_ARMED     = 1
+STATE_TRIGGERED = 2
+STATE_DONE      = 3
+
+
+class TriggerGate(Module):
+    """Forward or drop the words read from the DRAM FIFO.
+
+    While armed, nothing is forwarded and the oldest words are dropped
+    whenever more than pre words are stored in DRAM (level), keeping a
+    rolling pre-trigger window. Once triggered, the window and post more
+    words are forwarded (or everything if post is 0). Then everything is
+    dropped until armed again.
+    """
+    def __init__(self, dw, level):
+        self.sink = sink = stream.Endpoint([("data", dw)])
+        self.source = source = stream.Endpoint([("data", dw)])
+
+        self.state = Signal(2)      # input
+        self.pre = Signal(32)       # input, pre-trigger depth in words
+        self.post = Signal(32)      # input, post-trigger depth in words
+        self.trigger = Signal()     # input
+        self.done = Signal()        # output
+
+        # # #
+
+        remaining = Signal(32)
+        forward = Signal()
+        drop = Signal()
+
+        self.comb += [
+            If(self.state == STATE_ARMED,
+                drop.eq(level > self.pre),
+            ).Elif(self.state == STATE_DONE,
+                drop.eq(1),
+            ).Else(
+                forward.eq(1),
+            ),
+            sink.connect(source, omit={"valid", "ready"}),
+            source.valid.eq(sink.valid & forward),
+            sink.ready.eq((source.ready & forward) | drop),
+            self.done.eq((self.state == STATE_TRIGGERED) & (self.post != 0) &
+                         source.valid & source.ready & (remaining == 1)),
+        ]
+
+        self.sync += [
+            If(self.trigger,
+                # the window is what the DRAM FIFO holds
+                remaining.eq(level + self.post),
+            ).Elif(source.valid & source.ready & (remaining != 0),
+                remaining.eq(remaining - 1),
+            ),
+        ]
+
+
+class Trigger(Module, AutoCSR):
+    """Start forwarding the capture on a condition of the ULPI stream.
+
+    sink/source is the ULPI stream (forwarded unchanged) on which the
+    conditions are evaluated, gate the TriggerGate to insert after the DRAM
+    FIFO, level being its number of stored words. The trigger output is a
+    pulse to record the trigger time in the capture (ITICore.trigger).
+
+    The forwarded capture starts in the middle of a record: the host finds
+    the first record boundary with iti_decoder.find_alignment().
+
+    In mode 0 (reset value) everything is forwarded. In mode 1, arm starts a
+    capture keeping the last pre_trigger words; force triggers it. Packets
+    shorter than pattern_length bytes after the PID never match a pattern.
+    """
+    def __init__(self, level, dw=32, pattern_length=4):
+        self.sink = sink = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.source = source = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.trigger = Signal()
+
+        self.mode = CSRStorage()
+        self.arm = CSR()
+        self.force = CSR()
+        self.conditions = CSRStorage(3)
+        self.pid_mask = CSRStorage(16)
+        self.pattern = CSRStorage(8*pattern_length)
+        self.pattern_mask = CSRStorage(8*pattern_length)
+        self.linestate = CSRStorage(2)
+        self.linestate_duration = CSRStorage(32)
+        self.pre_trigger = CSRStorage(32)
+        self.post_trigger = CSRStorage(32)
+        self.state = CSRStatus(2)
+
+        # # #
+
+        self.submodules.gate = gate = TriggerGate(dw, level)
+
+        # packet conditions
+        in_packet = Signal()
+        checking = Signal()
+        index = Signal(max=pattern_length)
+        pid_match = Signal()
+        pattern_match = Signal()
+        packet_match = Signal()
+
+        pid = sink.data[0:4]
+        pid_valid = Signal()
+        byte_match = Signal()
+        pattern = Array(self.pattern.storage[8*i:8*(i + 1)] for i in range(pattern_length))
+        pattern_mask = Array(self.pattern_mask.storage[8*i:8*(i + 1)] for i in range(pattern_length))
+        self.comb += [
+            pid_valid.eq(((sink.data[4:8] ^ pid) == 0xf) & (self.pid_mask.storage >> pid)[0]),
+            byte_match.eq(((sink.data ^ pattern[index]) & pattern_mask[index]) == 0),
+            If(sink.valid & sink.ready & ~sink.cmd,
+                If(~in_packet,
+                    packet_match.eq(pid_valid & ~self.conditions.storage[1]),
+                ).Elif(checking & (index == pattern_length - 1),
+                    packet_match.eq(pid_match & pattern_match & byte_match),
+                ),
+            ),
+        ]
+        self.sync += [
+            If(sink.valid & sink.ready,
+                If(sink.cmd,
+                    If(~sink.data[4],
+                        # RxActive cleared
+                        in_packet.eq(0),
+                    ),
+                ).Elif(~in_packet,
+                    in_packet.eq(1),
+                    checking.eq(1),
+                    index.eq(0),
+                    pid_match.eq(pid_valid),
+                    pattern_match.eq(1),
+                ).Elif(checking,
+                    pattern_match.eq(pattern_match & byte_match),
+                    If(index == pattern_length - 1,
+                        checking.eq(0),
+                    ).Else(
+                        index.eq(index + 1),
+                    ),
+                ),
+            ),
+        ]
+
+        # linestate condition
+        linestate = Signal(2)
+        duration = Signal(32)
+        linestate_match = Signal()
+        self.comb += linestate_match.eq((linestate == self.linestate.storage) &
+                                        (duration == self.linestate_duration.storage))
+        self.sync += [
+            If(sink.valid & sink.ready,
+                duration.eq(0),
+                If(sink.cmd,
+                    linestate.eq(sink.data[0:2]),
+                ),
+            ).Elif(duration != 2**32 - 1,
+                duration.eq(duration + 1),
+            ),
+        ]
+
+        condition = Signal()
+        self.comb += [
+            sink.connect(source),
+            condition.eq((self.conditions.storage[0] & packet_match) |
+                         (self.conditions.storage[2] & linestate_match) |
+                         self.force.re),
+        ]
+
+        self.submodules.fsm = fsm = FSM()
+        fsm.act("FORWARD",
+            gate.state.eq(STATE_FORWARD),
+            If(self.mode.storage & self.arm.re,
+                NextState("ARMED"),
+            ),
+        )
+        fsm.act("ARMED",
+            gate.state.eq(STATE_ARMED),
+            If(~self.mode.storage,
+                NextState("FORWARD"),
+            ).Elif(condition,
+                self.trigger.eq(1),
+                NextState("TRIGGERED"),
+            ),
+        )
+        fsm.act("TRIGGERED",
+            gate.state.eq(STATE_TRIGGERED),
+            If(~self.mode.storage,
+                NextState("FORWARD"),
+            ).Elif(gate.done,
+                NextState("DONE"),
+            ),
+        )
+        fsm.act("DONE",
+            gate.state.eq(STATE_DONE),
+            If(~self.mode.storage,
+                NextState("FORWARD"),
+            ).Elif(self.arm.re,
+                NextState("ARMED"),
+            ),
+        )
+        self.comb += [
+            gate.trigger.eq(self.trigger),
+            gate.pre.eq(self.pre_trigger.storage),
+            gate.post.eq(self.post_trigger.storage),
+            self.state.status.eq(gate.state),
+        ]
+
+
+def tb_trigger(dut, packets, dram, received):
+    yield dut.source.ready.eq(1)
+    yield dut.gate.source.ready.eq(1)
+    yield dut.mode.storage.eq(1)
+    yield dut.conditions.storage.eq(CONDITION_PACKET | CONDITION_PATTERN)
+    yield dut.pid_mask.storage.eq(1 << 0x3) # DATA0
+    yield dut.pattern.storage.eq(0x0680)    # GET_DESCRIPTOR
+    yield dut.pattern_mask.storage.eq(0xffff)
+    yield dut.pre_trigger.storage.eq(4)
+    yield dut.post_trigger.storage.eq(3)
+    yield dut.arm.re.eq(1)
+    yield
+    yield dut.arm.re.eq(0)
+    for i in range(20):
+        yield
+    assert received == [] and dram == [6, 7, 8, 9]
+
+    # only the last packet matches
+    for i, packet in enumerate(packets):
+        for cmd, data in packet:
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.cmd.eq(cmd)
+            yield dut.sink.data.eq(data)
+            yield
+        yield dut.sink.valid.eq(0)
+        yield
+        state = STATE_TRIGGERED if i == len(packets) - 1 else STATE_ARMED
+        assert (yield dut.state.status) == state
+
+    # words captured after the trigger
+    for word in range(100, 110):
+        dram.append(word)
+        yield
+    for i in range(10):
+        yield
+    assert (yield dut.state.status) == STATE_DONE
+
+    # SE0 for 50 cycles
+    yield dut.conditions.storage.eq(CONDITION_LINESTATE)
+    yield dut.linestate.storage.eq(0b00)
+    yield dut.linestate_duration.storage.eq(50)
+    yield dut.arm.re.eq(1)
+    yield dut.sink.valid.eq(1)
+    yield dut.sink.cmd.eq(1)
+    yield dut.sink.data.eq(0x00)
+    yield
+    yield dut.arm.re.eq(0)
+    yield dut.sink.valid.eq(0)
+    for i in range(51):
+        yield
+    assert (yield dut.state.status) == STATE_ARMED
+    yield
+    assert (yield dut.state.status) == STATE_TRIGGERED
+
+
+@passive
+def tb_dram(dut, dram, received):
+    while (yield dut.state.status) == STATE_FORWARD:
+        yield
+    while True:
+        yield dut.level.eq(len(dram))
+        yield dut.gate.sink.valid.eq(len(dram) > 0)
+        yield dut.gate.sink.data.eq(dram[0] if dram else 0)
+        yield
+        if (yield dut.gate.sink.valid) and (yield dut.gate.sink.ready):
+            if (yield dut.gate.source.valid):
+                received.append(dram[0])
+            dram.pop(0)
+
+
+class TriggerTestBench(Module):
+    def __init__(self):
+        self.level = Signal(32)
+        self.submodules.trigger = Trigger(self.level)
+        for name in ["sink", "source", "gate", "mode", "arm", "conditions", "pid_mask",
+                     "pattern", "pattern_mask", "linestate", "linestate_duration",
+                     "pre_trigger", "post_trigger", "state"]:
+            setattr(self, name, getattr(self.trigger, name))
+
+
+if __name__ == "__main__":
+    # RxActive RXCMD, packet bytes, end of packet RXCMD
+    def packet(*data):
+        return [(1, 0x10)] + [(0, d) for d in data] + [(1, 0x00)]
+
+    setup = packet(0x2d, 0x00, 0x10)
+    set_address = packet(0xc3, 0x00, 0x05, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0xeb, 0x25)
+    get_descriptor = packet(0xc3, 0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00, 0xdd, 0x94)
+    packets = [setup, set_address, setup, get_descriptor]
+
+    dut = TriggerTestBench()
+    dram = list(range(10))
+    received = []
+    run_simulation(dut, [tb_trigger(dut, packets, dram, received), tb_dram(dut, dram, received)],
+        vcd_name="test/trigger.vcd")
+    # pre-trigger window, then post-trigger words
+    assert received == [6, 7, 8, 9, 100, 101, 102], received
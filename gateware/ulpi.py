@@ -1,4 +1,7 @@
 # Copyright (C) 2019 / LambdaConcept  / po@lambdaconcept.com
+from functools import reduce
+from operator import or_
+
 from migen import *
 
 from litex.soc.interconnect.csr import *
@@ -226,3 +229,329 @@ class ULPICore(Module, AutoCSR):
                 NextState("IDLE")
             )
         )
+
+class ULPIFilter(Module, AutoCSR):
+    """Drop whole USB packets from a ULPI stream according to their PID.
+
+    A packet starts on the first data byte (the PID) received after the
+    end of the previous one and ends on the first RXCMD with RxActive
+    cleared. Packets whose PID bit is set in mask are dropped from their
+    PID to their end RXCMD included; the RXCMD signalling the start of the
+    reception is kept as the PID is not known yet. Packets with a corrupted
+    PID are never dropped.
+    """
+    # mask bits (1 << PID)
+    OUT   = 1 << 0x1
+    IN    = 1 << 0x9
+    SOF   = 1 << 0x5
+    SETUP = 1 << 0xd
+    DATA0 = 1 << 0x3
+    DATA1 = 1 << 0xb
+    DATA2 = 1 << 0x7
+    MDATA = 1 << 0xf
+    ACK   = 1 << 0x2
+    NAK   = 1 << 0xa
+    STALL = 1 << 0xe
+    NYET  = 1 << 0x6
+    PRE   = 1 << 0xc
+    SPLIT = 1 << 0x8
+    PING  = 1 << 0x4
+
+    def __init__(self):
+        self.sink = sink = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.source = source = stream.Endpoint(ulpi_cmd_description(8, 1))
+
+        self.mask = CSRStorage(16)
+        self.reset = CSR()
+        self.dropped_packets = CSRStatus(32)
+        self.dropped_bytes = CSRStatus(32)
+
+        # # #
+
+        in_packet = Signal()
+        dropping = Signal()
+        drop = Signal()
+        drop_pid = Signal()
+        rx_active = Signal()
+
+        pid = sink.data[0:4]
+        self.comb += [
+            # RxEvent: 01 active, 11 error (still receiving)
+            rx_active.eq(sink.data[4]),
+            drop_pid.eq(~sink.cmd & ~in_packet &
+                        ((sink.data[4:8] ^ pid) == 0xf) & (self.mask.storage >> pid)[0]),
+            drop.eq(drop_pid | (in_packet & dropping)),
+
+            sink.connect(source, omit={"valid", "ready"}),
+            source.valid.eq(sink.valid & ~drop),
+            sink.ready.eq(source.ready | drop),
+        ]
+
+        self.sync += [
+            If(sink.valid & sink.ready,
+                If(sink.cmd,
+                    If(~rx_active,
+                        in_packet.eq(0),
+                        dropping.eq(0),
+                    ),
+                ).Elif(~in_packet,
+                    in_packet.eq(1),
+                    dropping.eq(drop_pid),
+                ),
+            ),
+            If(self.reset.re,
+                self.dropped_packets.status.eq(0),
+                self.dropped_bytes.status.eq(0),
+            ).Elif(sink.valid & drop,
+                If(drop_pid,
+                    self.dropped_packets.status.eq(self.dropped_packets.status + 1),
+                ),
+                self.dropped_bytes.status.eq(self.dropped_bytes.status + 1),
+            ),
+        ]
+
+
+def crc5(data):
+    """Return the USB CRC5 of the 11 bits of data (token fields)."""
+    crc = [1]*5
+    for i in range(11):
+        feedback = crc[0] ^ data[i]
+        # reflected polynomial 0x14
+        crc = [crc[1], crc[2], crc[3] ^ feedback, crc[4], feedback]
+    return Cat(*[bit ^ 1 for bit in crc])
+
+
+class ULPIAddressFilter(Module, AutoCSR):
+    """Only capture the packets of some device addresses / endpoints.
+
+    Token packets (OUT, IN, SETUP, PING) are held until their address and
+    endpoint are received, then forwarded if they match an enabled entry of
+    the match table, dropped otherwise along with the data and handshake
+    packets following them. Each matchN entry is: bits 0-6 address, bit 7
+    enable, bits 16-31 mask of the endpoints (bit N for endpoint N).
+
+    Tokens with a CRC5 error, and other packets (SOF, SPLIT, ...), are
+    always forwarded. The bytes of a held token reach ITICore (and are
+    timestamped) a few cycles late.
+    """
+    def __init__(self, entries=4):
+        self.sink = sink = stream.Endpoint(ulpi_cmd_description(8, 1))
+        self.source = source = stream.Endpoint(ulpi_cmd_description(8, 1))
+
+        self.enable = CSRStorage()
+        self.matches = []
+        for i in range(entries):
+            match = CSRStorage(32, name="match{}".format(i))
+            setattr(self, "match{}".format(i), match)
+            self.matches.append(match)
+        self.reset = CSR()
+        self.passed_packets = CSRStatus(32)
+        self.dropped_packets = CSRStatus(32)
+
+        # # #
+
+        self.submodules.buf = buf = stream.SyncFIFO(ulpi_cmd_description(8, 1), 8)
+
+        in_packet = Signal()
+        dropping = Signal()
+        gate = Signal(reset=1)
+        drop = Signal()
+        rx_active = Signal()
+        pid_start = Signal()
+        pid_valid = Signal()
+        token = Signal()
+        gated = Signal()
+        passed = Signal()
+        dropped = Signal()
+
+        count = Signal()
+        value = Signal(16)
+        addr = value[0:7]
+        endp = value[7:11]
+        crc_ok = Signal()
+        match = Signal()
+
+        pid = sink.data[0:4]
+        self.comb += [
+            rx_active.eq(sink.data[4]),
+            pid_start.eq(sink.valid & ~sink.cmd & ~in_packet),
+            pid_valid.eq((sink.data[4:8] ^ pid) == 0xf),
+            # OUT, IN, SETUP, PING
+            token.eq(pid_valid & ((pid == 0x1) | (pid == 0x9) | (pid == 0xd) | (pid == 0x4))),
+            # DATA0/1/2, MDATA, ACK, NAK, STALL, NYET
+            gated.eq(pid_valid & ((pid[0:2] == 0b11) | (pid[0:2] == 0b10))),
+
+            crc_ok.eq(crc5(value[0:11]) == value[11:16]),
+            match.eq(reduce(or_, [m.storage[7] & (m.storage[0:7] == addr) & (m.storage[16:32] >> endp)[0]
+                                  for m in self.matches])),
+        ]
+
+        self.submodules.fsm = fsm = FSM()
+        fsm.act("NORMAL",
+            If(pid_start & token & self.enable.storage,
+                # hold the token
+                sink.connect(buf.sink),
+            ).Else(
+                drop.eq((pid_start & gated & ~gate & self.enable.storage) | (in_packet & dropping)),
+                sink.connect(source, omit={"valid", "ready"}),
+                source.valid.eq(sink.valid & ~drop),
+                sink.ready.eq(source.ready | drop),
+            ),
+            If(sink.valid & sink.ready,
+                If(sink.cmd,
+                    If(~rx_active,
+                        NextValue(in_packet, 0),
+                        NextValue(dropping, 0),
+                    ),
+                ).Elif(~in_packet,
+                    NextValue(in_packet, 1),
+                    NextValue(dropping, drop),
+                    If(token & self.enable.storage,
+                        NextValue(count, 0),
+                        NextState("HOLD"),
+                    ).Else(
+                        passed.eq(~drop),
+                        dropped.eq(drop),
+                    ),
+                ),
+            ),
+        )
+        fsm.act("HOLD",
+            sink.connect(buf.sink),
+            If(sink.valid & sink.ready,
+                If(sink.cmd,
+                    If(~rx_active,
+                        # token too short
+                        NextValue(in_packet, 0),
+                        NextValue(gate, 1),
+                        passed.eq(1),
+                        NextState("RELEASE"),
+                    ),
+                ).Else(
+                    NextValue(count, 1),
+                    If(count,
+                        NextValue(value[8:16], sink.data),
+                        NextState("DECIDE"),
+                    ).Else(
+                        NextValue(value[0:8], sink.data),
+                    ),
+                ),
+            ).Elif(~buf.sink.ready,
+                NextValue(gate, 1),
+                passed.eq(1),
+                NextState("RELEASE"),
+            ),
+        )
+        fsm.act("DECIDE",
+            NextValue(gate, match | ~crc_ok),
+            NextValue(dropping, ~match & crc_ok),
+            If(match | ~crc_ok,
+                passed.eq(1),
+                NextState("RELEASE"),
+            ).Else(
+                dropped.eq(1),
+                NextState("DISCARD"),
+            ),
+        )
+        fsm.act("RELEASE",
+            buf.source.connect(source),
+            If(~buf.source.valid,
+                NextState("NORMAL"),
+            ),
+        )
+        fsm.act("DISCARD",
+            buf.source.ready.eq(1),
+            If(~buf.source.valid,
+                NextState("NORMAL"),
+            ),
+        )
+
+        self.sync += [
+            If(self.reset.re,
+                self.passed_packets.status.eq(0),
+                self.dropped_packets.status.eq(0),
+            ).Else(
+                If(passed,
+                    self.passed_packets.status.eq(self.passed_packets.status + 1),
+                ),
+                If(dropped,
+                    self.dropped_packets.status.eq(self.dropped_packets.status + 1),
+                ),
+            ),
+        ]
+
+
+def tb_stream(dut, packets):
+    yield dut.source.ready.eq(1)
+    for packet in packets:
+        for cmd, data in packet:
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.cmd.eq(cmd)
+            yield dut.sink.data.eq(data)
+            yield
+            while not (yield dut.sink.ready):
+                yield
+        yield dut.sink.valid.eq(0)
+        for i in range(4):
+            yield
+
+
+def tb_filter(dut, packets):
+    yield dut.mask.storage.eq(ULPIFilter.SOF | ULPIFilter.NAK)
+    yield from tb_stream(dut, packets)
+    print("dropped {} packets, {} bytes".format(
+        (yield dut.dropped_packets.status), (yield dut.dropped_bytes.status)))
+
+
+def tb_address_filter(dut, packets):
+    yield dut.enable.storage.eq(1)
+    # address 5, endpoint 1
+    yield dut.match1.storage.eq((1 << (16 + 1)) | 0x80 | 5)
+    yield from tb_stream(dut, packets)
+    print("passed {} packets, dropped {} packets".format(
+        (yield dut.passed_packets.status), (yield dut.dropped_packets.status)))
+
+
+@passive
+def tb_monitor(dut, received):
+    while True:
+        if (yield dut.source.valid) and (yield dut.source.ready):
+            received.append(((yield dut.source.cmd), (yield dut.source.data)))
+        yield
+
+
+if __name__ == "__main__":
+    # RxActive RXCMD, packet bytes, end of packet RXCMD
+    def packet(*data):
+        return [(1, 0x10)] + [(0, d) for d in data] + [(1, 0x00)]
+
+    sof = packet(0xa5, 0x23, 0x41)
+    nak = packet(0x5a)
+    ack = packet(0xd2)
+    data = packet(0x4b, 0x01, 0x02, 0x7e, 0x1e)
+    bad_sof = packet(0x55, 0x23, 0x41) # PID check bits mismatch
+    packets = [sof, data, nak, sof, bad_sof, data]
+    received = []
+
+    dut = ULPIFilter()
+    run_simulation(dut, [tb_filter(dut, packets), tb_monitor(dut, received)],
+        vcd_name="test/ulpi_filter.vcd")
+    # dropped packets only keep their RxActive RXCMD (SOF, NAK)
+    expected = sum((p if p in (data, bad_sof) else p[:1] for p in packets), [])
+    assert received == expected, received
+
+    in_5_1 = packet(0x69, 0x85, 0x60)
+    in_3_1 = packet(0x69, 0x83, 0xe0)
+    out_5_2 = packet(0xe1, 0x05, 0xf9)
+    in_bad_crc = packet(0x69, 0x83, 0xe1)
+    packets = [in_5_1, data, ack, in_3_1, data, ack, sof, out_5_2, data, nak,
+               in_bad_crc, nak, in_5_1, nak]
+    received = []
+
+    dut = ULPIAddressFilter()
+    run_simulation(dut, [tb_address_filter(dut, packets), tb_monitor(dut, received)],
+        vcd_name="test/ulpi_address_filter.vcd")
+    # IN/OUT to other addresses / endpoints, and their data and handshakes
+    dropped = [3, 4, 5, 7, 8, 9]
+    expected = sum((p[:1] if i in dropped else p for i, p in enumerate(packets)), [])
+    assert received == expected, received
@@ -0,0 +1,171 @@
+import os
+import asyncio
+import collections
+
+from litex.soc.tools.remote.csr_builder import CSRBuilder
+
+from etherbone import USBMux, USBStream, streams_stats
+from etherbone_codec import EtherboneCodec, max_count
+from etherbone import STREAMID_WISHBONE, STREAMID_ULPI0, STREAMID_ULPI1
+
+
+class AsyncUSBMux(USBMux):
+    """asyncio variant of USBMux.
+
+    The device fd is registered as a reader on the event loop: received
+    chunks are framed as they arrive and packets are dispatched to bounded
+    per stream asyncio queues, so one loop can drive many devices. Create
+    it from a coroutine running on that loop, or give the loop.
+    """
+    def __init__(self, path, streamids=(STREAMID_WISHBONE, STREAMID_ULPI0, STREAMID_ULPI1),
+                 depth=4096, loop=None, **kwargs):
+        USBMux.__init__(self, path, streamids, **kwargs)
+        self.fd = self.f.fileno()
+        os.set_blocking(self.fd, False)
+
+        self.loop = asyncio.get_running_loop() if loop is None else loop
+        self.streams = {sid: USBStream(asyncio.Queue(depth)) for sid in streamids}
+        self.unknown = 0
+        self.error = None
+
+        self.send_lock = asyncio.Lock()
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            n = self._fill()
+            if n is None:
+                return
+            if n == 0:
+                raise EOFError("USB device closed")
+            while True:
+                packet = self._frame()
+                if packet is None:
+                    break
+                sid, data = packet
+                stream = self.streams.get(sid)
+                if stream is None:
+                    self.unknown += 1
+                else:
+                    stream.put(bytes(data), full=asyncio.QueueFull)
+        except Exception as e:
+            self.error = e
+            self.loop.remove_reader(self.fd)
+            # wake up pending receivers
+            for stream in self.streams.values():
+                if not stream.queue.full():
+                    stream.queue.put_nowait(None)
+
+    async def _writable(self):
+        future = self.loop.create_future()
+        self.loop.add_writer(self.fd, future.set_result, None)
+        try:
+            await future
+        finally:
+            self.loop.remove_writer(self.fd)
+
+    async def send(self, streamid, packet):
+        data = memoryview(self.header.pack(self.magic, streamid, len(packet)) + packet)
+        async with self.send_lock:
+            while data:
+                try:
+                    n = os.write(self.fd, data)
+                except BlockingIOError:
+                    await self._writable()
+                    continue
+                data = data[n:]
+
+    async def recv(self, streamid):
+        stream = self.streams[streamid]
+        if stream.queue.empty() and self.error is not None:
+            raise self.error
+        packet = await stream.queue.get()
+        if packet is None:
+            raise self.error
+        return packet
+
+    def close(self):
+        if self.error is None:
+            self.loop.remove_reader(self.fd)
+        self.f.close()
+
+    def stats(self):
+        return streams_stats(self.streams, self.unknown)
+
+
+class AsyncEtherbone(CSRBuilder):
+    """asyncio variant of Etherbone.
+
+    Reads return futures resolved by a background task in request order,
+    the gateware answering records one at a time, so many CSR transactions
+    can be outstanding concurrently. CSRBuilder registers only provide the
+    addresses here: use `await eb.read(eb.regs.<name>.addr)`.
+    """
+    def __init__(self, io, streamid, csr_csv=None, csr_data_width=32, debug=False):
+        self.io = io
+        self.streamid = streamid
+        if csr_csv is not None:
+            CSRBuilder.__init__(self, self, csr_csv, csr_data_width)
+        self.debug = debug
+
+        self.pending = collections.deque()
+        self.task = None
+        self.codec = EtherboneCodec()
+
+    async def _receive(self):
+        try:
+            while True:
+                data = await self.io.recv(self.streamid)
+                datas = self.codec.decode_writes(data)
+                future = self.pending.popleft()
+                if not future.cancelled():
+                    future.set_result(datas)
+        except Exception as e:
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.cancelled():
+                    future.set_exception(e)
+
+    async def _request(self, addrs, future):
+        # encoded here: send copies the shared codec buffer before yielding
+        await self.io.send(self.streamid, self.codec.encode_reads(addrs))
+        # responses come back in order: queued in send order, no other task
+        # can send between the end of the send and here
+        self.pending.append(future)
+
+    async def _read(self, addrs):
+        if self.task is None or self.task.done():
+            # (re)start the receiver, it exits on errors
+            self.task = asyncio.ensure_future(self._receive())
+
+        future = asyncio.get_running_loop().create_future()
+        # a cancelled read still completes its request, so that its response
+        # is matched to it (and dropped)
+        await asyncio.shield(self._request(addrs, future))
+        return await future
+
+    async def read(self, addr, length=None):
+        length_int = 1 if length is None else length
+        records = []
+        for offset in range(0, length_int, max_count):
+            count = min(max_count, length_int - offset)
+            records.append(self._read(range(addr + 4*offset, addr + 4*(offset + count), 4)))
+        datas = [data for datas in await asyncio.gather(*records) for data in datas]
+        if self.debug:
+            for i, data in enumerate(datas):
+                print("read {:08x} @ {:08x}".format(data, addr + 4*i))
+        return datas[0] if length is None else datas
+
+    async def write(self, addr, datas):
+        datas = datas if isinstance(datas, list) else [datas]
+        for offset in range(0, len(datas), max_count):
+            burst = datas[offset:offset + max_count]
+            await self.io.send(self.streamid, self.codec.encode_writes(addr + 4*offset, burst))
+
+        if self.debug:
+            for i, data in enumerate(datas):
+                print("write {:08x} @ {:08x}".format(data, addr + 4*i))
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,242 @@
+import json
+import mmap
+import time
+import bisect
+import struct
+import collections
+
+from iti_decoder import ITIDecoder, record_sizes
+
+# file layout:
+#   header:  magic, version, chunk size, metadata length, metadata (json)
+#   chunks:  raw capture stream (Conv4032 words), chunk_size bytes each,
+#            the last one possibly shorter
+#   index:   one entry per chunk
+#   footer:  index offset, number of entries, magic
+magic = b"USBSNIFF"
+version = 1
+header = struct.Struct("<8sIII")
+footer = struct.Struct("<QI8s")
+footer_magic = b"USBSIDX1"
+
+# chunk offset, length, offset of the first record starting in the chunk,
+# timestamp before that record, decoder synced at that record
+index_entry = struct.Struct("<QIIQB7x")
+
+IndexEntry = collections.namedtuple("IndexEntry", "offset length align timestamp synced")
+
+
+class CaptureWriter():
+    """Write a raw ITI capture stream to an indexed capture file.
+
+    The stream is decoded while written to know, for each chunk, where its
+    first record starts and the absolute timestamp before it, so that
+    readers can start decoding from any chunk. metadata is any json
+    serializable object (CSR configuration, ULPI registers, SoC
+    identifier...).
+    """
+    def __init__(self, path, metadata=None, chunk_size=1024*1024, decoder=None):
+        self.f = open(path, "wb")
+        self.chunk_size = chunk_size
+        self.decoder = ITIDecoder() if decoder is None else decoder
+        self.index = []
+        self.buf = bytearray()
+        self.records = 0
+
+        meta = json.dumps(metadata or {}).encode()
+        self.f.write(header.pack(magic, version, chunk_size, len(meta)))
+        self.f.write(meta)
+        self.offset = header.size + len(meta)
+
+    def _chunk(self, data):
+        decoder = self.decoder
+        pending = decoder.pending
+        timestamp = decoder.timestamp
+        synced = decoder.synced
+        records = decoder.decode(data)
+        if pending and synced:
+            # a record started in the previous chunk ends in this one
+            align = record_sizes[pending[0]] - len(pending)
+            if records:
+                timestamp = records[0][0]
+        else:
+            align = 0
+        if align > len(data):
+            align, synced = 0, False
+        self.index.append(IndexEntry(self.offset, len(data), align, timestamp, synced))
+        self.f.write(data)
+        self.offset += len(data)
+        self.records += len(records)
+        return records
+
+    def write(self, data):
+        """Append data to the capture, return the records completed by it."""
+        self.buf += data
+        records = []
+        while len(self.buf) >= self.chunk_size:
+            records += self._chunk(bytes(self.buf[:self.chunk_size]))
+            del self.buf[:self.chunk_size]
+        return records
+
+    def close(self):
+        if self.buf:
+            self._chunk(bytes(self.buf))
+            self.buf = bytearray()
+        for entry in self.index:
+            self.f.write(index_entry.pack(*entry))
+        self.f.write(footer.pack(self.offset, len(self.index), footer_magic))
+        self.f.close()
+
+
+class CaptureFile():
+    """Read an indexed capture file through mmap.
+
+    seek() finds the chunk holding a timestamp by a binary search of the
+    index, records() decodes from any chunk without decoding the previous
+    ones.
+    """
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _magic, _version, self.chunk_size, length = header.unpack_from(self.mm, 0)
+        if _magic != magic or _version != version:
+            raise ValueError("{} is not a capture file".format(path))
+        self.metadata = json.loads(self.mm[header.size:header.size + length])
+
+        index_offset, count, _magic = footer.unpack_from(self.mm, len(self.mm) - footer.size)
+        if _magic != footer_magic:
+            raise ValueError("{} has no index (capture not closed?)".format(path))
+        self.index = [IndexEntry(*e) for e in index_entry.iter_unpack(
+            self.mm[index_offset:index_offset + count*index_entry.size])]
+        self.timestamps = [e.timestamp for e in self.index]
+        self.data_start = header.size + length
+        self.data_end = index_offset
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def data(self, start=0, end=None):
+        """Return a memoryview of the raw stream of chunks start to end."""
+        end = len(self.index) if end is None else end
+        if start >= end:
+            return memoryview(b"")
+        first, last = self.index[start], self.index[end - 1]
+        return memoryview(self.mm)[first.offset:last.offset + last.length]
+
+    def seek(self, timestamp):
+        """Return the index of the last chunk starting at or before timestamp."""
+        return max(0, bisect.bisect_right(self.timestamps, timestamp) - 1)
+
+    def decoder(self, chunk):
+        """Return (decoder, offset) to start decoding at chunk."""
+        entry = self.index[chunk]
+        return ITIDecoder(entry.timestamp, entry.synced), entry.offset + entry.align
+
+    def records(self, chunk=0, timestamp=None, decode_size=64*1024):
+        """Yield the records from chunk, or from timestamp if given."""
+        if timestamp is not None:
+            chunk = self.seek(timestamp)
+        if chunk >= len(self.index):
+            return
+        decoder, offset = self.decoder(chunk)
+        for start in range(offset, self.data_end, decode_size):
+            # bytes: an unsynced decoder searches them for the start pattern
+            records = decoder.decode(self.mm[start:min(start + decode_size, self.data_end)])
+            if timestamp is not None:
+                records = [r for r in records if r[0] >= timestamp]
+                if records:
+                    timestamp = None
+            yield from records
+
+
+def record(io, streamid, path, metadata=None, decoder=None, duration=None):
+    """Write the data received on streamid of a USBMux/USBDemux to a
+    capture file, until EOF or duration seconds."""
+    writer = CaptureWriter(path, metadata, decoder=decoder)
+    deadline = None if duration is None else time.monotonic() + duration
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                data = io.recv(streamid)
+            except EOFError:
+                break
+            if data is not None:
+                writer.write(data)
+    finally:
+        writer.close()
+    return writer
+
+
+def bench(n=2000000):
+    import os
+    import random
+    import tempfile
+    from iti_decoder import encode_record, start_pattern, PAYLOAD_DATA
+
+    random.seed(0)
+    encoded = [encode_record(random.choice([1, 20, 5000]), PAYLOAD_DATA, i & 0xff)
+               for i in range(n)]
+    raw = b"".join(encoded)
+    reference = ITIDecoder().decode(raw)
+
+    fd, path = tempfile.mkstemp(suffix=".usbsniff")
+    os.close(fd)
+    try:
+        writer = CaptureWriter(path, {"identifier": "test"}, chunk_size=64*1024)
+        for i in range(0, len(raw), 10007):
+            writer.write(raw[i:i + 10007])
+        writer.close()
+
+        capture = CaptureFile(path)
+        assert capture.metadata == {"identifier": "test"}
+        assert bytes(capture.data()) == raw
+        assert list(capture.records()) == reference
+        # decoding can start from any chunk
+        timestamps = {r[0]: i for i, r in enumerate(reference)}
+        for chunk in range(len(capture)):
+            records = capture.records(chunk)
+            first = next(records)
+            records.close()
+            assert reference[timestamps[first[0]]] == first
+
+        # seek in the middle of the capture
+        target = reference[n//2][0]
+        start = time.perf_counter()
+        records = capture.records(timestamp=target)
+        first = next(records)
+        elapsed = time.perf_counter() - start
+        assert first == next(r for r in reference if r[0] >= target)
+        print("{} chunks, first record at timestamp {} in {:.1f} ms".format(
+            len(capture), target, elapsed*1e3))
+        records.close()
+        capture.close()
+
+        # capture started out of sync (sniff.py), losing the alignment in
+        # the middle: the readers resync on the start patterns
+        junk = bytes([0x05])*5000
+        raw = b"".join([junk, start_pattern] + encoded[:n//2] + [junk, start_pattern] + encoded[n//2:])
+        reference = ITIDecoder(synced=False).decode(raw)
+        assert len(reference) == n + 2*len(start_pattern)//3
+        writer = CaptureWriter(path, chunk_size=4096, decoder=ITIDecoder(synced=False))
+        writer.write(raw)
+        writer.close()
+        capture = CaptureFile(path)
+        synced = [entry.synced for entry in capture.index]
+        assert not synced[0] and synced.count(False) == 3 and synced[-1]
+        assert list(capture.records(decode_size=1000)) == reference
+        timestamps = {r[0]: i for i, r in enumerate(reference)}
+        for chunk in range(0, len(capture), 7):
+            first = next(capture.records(chunk))
+            assert reference[timestamps[first[0]]] == first
+        capture.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
@@ -1,52 +1,260 @@
+import time
+import queue
 import struct
+import threading
 
-from litex.soc.tools.remote.etherbone import *
 from litex.soc.tools.remote.csr_builder import CSRBuilder
 
+from etherbone_codec import EtherboneCodec, max_count, max_packet_words
+
+STREAMID_WISHBONE = 0
+STREAMID_ULPI0 = 1
+STREAMID_ULPI1 = 2
+
 class USBMux():
-    def __init__(self, path):
-        self.f = open(path, "r+b")
+    """Host side of the USBCore stream multiplexer.
+
+    Data is pulled from the device in large chunks into a preallocated
+    buffer and packets are framed out of it as memoryview slices. A slice
+    returned by packets() is only valid until the next iteration.
+
+    Headers with a bad preamble, an unknown streamid or an insane length
+    make the framer skip ahead to the next preamble; resync events and
+    skipped bytes are counted instead of raising.
+    """
+    wire_rate = 100e6*4 # FT601 @ 100MHz x 32 bits
+
+    # WrapSender sends at most 128 words, etherbone replies carry at most
+    # 255 words plus headers
+    max_length = 2048
+
+    def __init__(self, path, streamids=(STREAMID_WISHBONE, STREAMID_ULPI0, STREAMID_ULPI1),
+                 chunk_size=1024*1024, buffer_size=4*1024*1024):
+        assert(buffer_size >= 2*chunk_size)
+        # unbuffered so that a reader thread never holds a lock needed by send
+        self.f = open(path, "r+b", buffering=0)
         self.magic = 0x5aa55aa5
+        self.header = struct.Struct("III")
+        self.preamble = struct.pack("I", self.magic)
+        self.streamids = set(streamids)
+
+        self.chunk_size = chunk_size
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.rd = 0 # start of unframed data
+        self.wr = 0 # end of received data
+
+        self.rx_bytes = 0
+        self.rx_start = None
+
+        self.synced = True
+        self.resyncs = 0
+        self.lost_bytes = 0
+
+        self._packets = self.packets()
 
     def send(self, streamid, packet):
         length = len(packet)
-        header = struct.pack("III", self.magic, streamid, length)
-        data = header + packet
+        header = self.header.pack(self.magic, streamid, length)
+        data = memoryview(header + packet)
         # print("send:", data.hex())
-        self.f.write(data)
+        while data:
+            n = self.f.write(data)
+            data = data[n:]
+
+    def _fill(self):
+        if self.wr + self.chunk_size > len(self.buf):
+            # move unframed data back to the start of the buffer
+            pending = self.wr - self.rd
+            self.view[:pending] = self.view[self.rd:self.wr]
+            self.rd, self.wr = 0, pending
+        n = self.f.readinto(self.view[self.wr:self.wr + self.chunk_size])
+        if n is None:
+            # non-blocking device, nothing to read yet
+            return None
+        if self.rx_start is None:
+            self.rx_start = time.perf_counter()
+        self.rx_bytes += n
+        self.wr += n
+        return n
+
+    def _resync(self):
+        if self.synced:
+            self.synced = False
+            self.resyncs += 1
+        start = self.buf.find(self.preamble, self.rd + 1, self.wr)
+        if start < 0:
+            # keep a possibly truncated preamble at the end of the buffer
+            start = self.wr - (len(self.preamble) - 1)
+        self.lost_bytes += start - self.rd
+        self.rd = start
+
+    def _frame(self):
+        while True:
+            if self.wr - self.rd < self.header.size:
+                return None
+            magic, sid, length = self.header.unpack_from(self.buf, self.rd)
+            if (magic == self.magic and sid in self.streamids and
+                length <= self.max_length and not length % 4):
+                break
+            self._resync()
+        self.synced = True
+        start = self.rd + self.header.size
+        end = start + length
+        if end > self.wr:
+            return None
+        self.rd = end
+        return sid, self.view[start:end]
+
+    def packets(self):
+        """Yield (streamid, payload) tuples until the device reaches EOF."""
+        while True:
+            packet = self._frame()
+            if packet is not None:
+                yield packet
+            elif not self._fill():
+                return
 
     def recv(self, streamid):
-        magic = 0
-        while magic != self.magic:
-            data = self.f.read(4)
-            magic, = struct.unpack("I", data)
-            # print("Magic:", data.hex())
-            try:
-                assert(magic == self.magic)
-            except AssertionError as e:
-                print("ASSERT ERROR!")
-                for k in range(64):
-                    data = self.f.read(4)
-                    print(data.hex())
-                raise e
-        data = self.f.read(8)
-        sid, length = struct.unpack("II", data)
-        # print("Header:", hex(magic), sid, length)
-        # print(data.hex())
-        packet = self.f.read(length)
+        try:
+            sid, packet = next(self._packets)
+        except StopIteration:
+            raise EOFError("USB device closed")
+        # print("Header:", sid, len(packet))
         # print("Packet:", packet.hex())
         if sid != streamid:
             print("Not our stream, drop packet")
             return None
-        return packet
+        return bytes(packet)
+
+    def throughput(self):
+        """Return the sustained receive rate in MB/s."""
+        if self.rx_start is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.rx_start
+        return self.rx_bytes/elapsed/1e6 if elapsed else 0.0
+
+    def stats(self):
+        rate = self.throughput()
+        return "{:.2f} MB/s ({:.1f}% of wire), {} resyncs, {} bytes lost".format(
+            rate, 100*rate*1e6/self.wire_rate, self.resyncs, self.lost_bytes)
+
+class USBStream():
+    def __init__(self, queue):
+        self.queue = queue
+        self.count = 0
+        self.drops = 0
+        self.high_water = 0
+
+    def put(self, packet, full=queue.Full):
+        try:
+            self.queue.put_nowait(packet)
+        except full:
+            self.drops += 1
+            return
+        self.count += 1
+        self.high_water = max(self.high_water, self.queue.qsize())
+
+def streams_stats(streams, unknown):
+    r = []
+    for sid, stream in streams.items():
+        r.append("stream {}: {} packets, {} dropped, high-water {}/{}".format(
+            sid, stream.count, stream.drops, stream.high_water, stream.queue.maxsize))
+    if unknown:
+        r.append("unknown streams: {} packets".format(unknown))
+    return "\n".join(r)
+
+class USBDemux():
+    """Read a USBMux from a background thread and dispatch its packets to
+    bounded per stream queues, so that control traffic and captures can
+    share the link. Packets arriving on a full queue are dropped and
+    counted.
+    """
+    def __init__(self, usbmux, streamids=(STREAMID_WISHBONE, STREAMID_ULPI0, STREAMID_ULPI1),
+                 depth=4096):
+        self.usbmux = usbmux
+        self.streams = {sid: USBStream(queue.Queue(depth)) for sid in streamids}
+        self.unknown = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for sid, packet in self.usbmux.packets():
+                stream = self.streams.get(sid)
+                if stream is None:
+                    self.unknown += 1
+                else:
+                    stream.put(bytes(packet))
+        except Exception as e:
+            self.error = e
+
+    def send(self, streamid, packet):
+        self.usbmux.send(streamid, packet)
+
+    def recv(self, streamid, timeout=None):
+        """Return the next packet of streamid, or None on timeout."""
+        stream = self.streams[streamid]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return stream.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            if not self.thread.is_alive() and stream.queue.empty():
+                if self.error is not None:
+                    raise self.error
+                raise EOFError("USB device closed")
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+
+    def stats(self):
+        return streams_stats(self.streams, self.unknown)
 
 class Etherbone(CSRBuilder):
-    def __init__(self, io, streamid, csr_csv=None, csr_data_width=32, debug=False):
+    """Etherbone client over a USBMux/USBDemux stream.
+
+    With write_behind enabled, writes are queued and adjacent ones are
+    coalesced into bursts; the queue is flushed before the next read or on
+    an explicit flush(), chaining the bursts as records of a few packets.
+    Scripts relying on write timing (sleeps between writes) must flush()
+    themselves.
+
+    With shadow enabled, the values of CSRStorage registers (only ever
+    modified by the host) are cached when written or read, and served
+    locally on later reads; status registers always go to the hardware.
+    csr.csv exports plain CSR registers (write strobes, event status) as
+    "rw" like storage ones: they are told apart by the strobe_registers
+    name suffixes and never cached.
+    The cache is invalidated when the ResetManager or the SoC is reset,
+    or on an explicit invalidate().
+    """
+    reset_registers = ["rst_manager_reset", "ctrl_reset"]
+    strobe_registers = ("_reset", "_latch", "_arm", "_force", "_event", "_start_pattern",
+                        "_reg_write", "_reg_read", "_ev_status", "_ev_pending", "_rxtx")
+
+    def __init__(self, io, streamid, csr_csv=None, csr_data_width=32, debug=False,
+                 write_behind=False, shadow=False):
         self.io = io
         self.streamid = streamid
+        self.storage_addrs = set()
+        self.reset_addrs = set()
         if csr_csv is not None:
             CSRBuilder.__init__(self, self, csr_csv, csr_data_width)
+            for name, reg in self.regs.d.items():
+                addrs = range(reg.addr, reg.addr + 4*reg.length, 4)
+                if name in self.reset_registers:
+                    self.reset_addrs.update(addrs)
+                elif reg.mode == "rw" and not name.endswith(self.strobe_registers):
+                    self.storage_addrs.update(addrs)
         self.debug = debug
+        self.write_behind = write_behind
+        self.writes = []
+        self.shadow = {} if shadow else None
+        self.shadow_hits = 0
+        self.codec = EtherboneCodec()
 
     def open(self):
         pass
@@ -54,43 +262,172 @@ class Etherbone(CSRBuilder):
     def close(self):
         pass
 
+    def _send_reads(self, addrs):
+        self.io.send(self.streamid, self.codec.encode_reads(addrs))
+
+    def _recv_datas(self):
+        data = None
+        while data is None:
+            data = self.io.recv(self.streamid)
+        return self.codec.decode_writes(data)
+
+    def read_block(self, addr, nwords, inflight=4):
+        """Read nwords consecutive words starting at addr.
+
+        Reads are packed by up to 255 addresses per record (the maximum
+        rcount) and up to inflight packets are kept outstanding.
+        """
+        if self.shadow is not None:
+            addrs = range(addr, addr + 4*nwords, 4)
+            if all(a in self.shadow for a in addrs):
+                self.shadow_hits += 1
+                return [self.shadow[a] for a in addrs]
+
+        self.flush()
+        datas = []
+        pending = 0
+        for offset in range(0, nwords, max_count):
+            if pending == inflight:
+                datas += self._recv_datas()
+                pending -= 1
+            count = min(max_count, nwords - offset)
+            self._send_reads(range(addr + 4*offset, addr + 4*(offset + count), 4))
+            pending += 1
+        for i in range(pending):
+            datas += self._recv_datas()
+
+        self._update_shadow(addr, datas)
+        return datas
+
     def read(self, addr, length=None):
         length_int = 1 if length is None else length
-        datas = []
-        for i in range(length_int):
-            record = EtherboneRecord()
-            record.reads = EtherboneReads(addrs=[addr + 4*i])
-            record.rcount = 1
-
-            packet = EtherbonePacket()
-            packet.records = [record]
-            packet.encode()
-
-            self.io.send(self.streamid, bytes(packet))
-            data = None
-            while data is None:
-                data = self.io.recv(self.streamid)
-
-            packet = EtherbonePacket(data)
-            packet.decode()
-            datas.append(packet.records.pop().writes.get_datas()[0])
+        datas = self.read_block(addr, length_int)
         if self.debug:
             for i, data in enumerate(datas):
                 print("read {:08x} @ {:08x}".format(data, addr + 4*i))
         return datas[0] if length is None else datas
 
-    def write(self, addr, datas):
-        datas = datas if isinstance(datas, list) else [datas]
+    def _send_writes(self, writes):
+        # chain the bursts as records of as few packets as possible
+        bursts = []
+        words = 0
+        for addr, datas in writes:
+            for offset in range(0, len(datas), max_count):
+                burst = datas[offset:offset + max_count]
+                if words + len(burst) + 1 > max_packet_words:
+                    self.io.send(self.streamid, self.codec.encode_write_records(bursts))
+                    bursts = []
+                    words = 0
+                bursts.append((addr + 4*offset, burst))
+                words += len(burst) + 1
+        if bursts:
+            self.io.send(self.streamid, self.codec.encode_write_records(bursts))
+
+    def _update_shadow(self, addr, datas):
+        if self.shadow is None:
+            return
         for i, data in enumerate(datas):
-            record = EtherboneRecord()
-            record.writes = EtherboneWrites(base_addr=addr + 4*i, datas=[data])
-            record.wcount = 1
+            if addr + 4*i in self.storage_addrs:
+                self.shadow[addr + 4*i] = data
+
+    def invalidate(self):
+        if self.shadow is not None:
+            self.shadow.clear()
 
-            packet = EtherbonePacket()
-            packet.records = [record]
-            packet.encode()
+    def flush(self):
+        writes, self.writes = self.writes, []
+        self._send_writes(writes)
 
-            self.io.send(self.streamid, bytes(packet))
+    def write(self, addr, datas):
+        datas = datas if isinstance(datas, list) else [datas]
+        if self.reset_addrs.intersection(range(addr, addr + 4*len(datas), 4)):
+            # reset modules get their storage registers back to defaults
+            self.invalidate()
+        self._update_shadow(addr, datas)
+        if self.write_behind:
+            if self.writes and addr == self.writes[-1][0] + 4*len(self.writes[-1][1]):
+                # adjacent to the previous write, extend its burst
+                self.writes[-1][1].extend(datas)
+            else:
+                self.writes.append((addr, list(datas)))
+        else:
+            self._send_writes([(addr, datas)])
 
-            if self.debug:
+        if self.debug:
+            for i, data in enumerate(datas):
                 print("write {:08x} @ {:08x}".format(data, addr + 4*i))
+
+
+def bench(n=20000):
+    import os
+    import tempfile
+    from etherbone_codec import packet_header, record_header
+
+    class Device():
+        """Replies to etherbone records, reads of status registers count up."""
+        def __init__(self, status_addrs):
+            self.codec = EtherboneCodec()
+            self.status_addrs = status_addrs
+            self.regs = {}
+            self.replies = []
+            self.packets = 0
+
+        def send(self, streamid, data):
+            data = bytes(data)
+            self.packets += 1
+            offset = packet_header.size
+            while offset < len(data):
+                _, _, wcount, rcount = record_header.unpack_from(data, offset)
+                words = struct.unpack_from(">{}I".format(wcount + rcount + 1), data,
+                                           offset + record_header.size)
+                offset += record_header.size + 4*len(words)
+                for i, word in enumerate(words[1:wcount + 1]):
+                    self.regs[words[0] + 4*i] = word
+                if rcount:
+                    for addr in words[1:]:
+                        if addr in self.status_addrs:
+                            self.regs[addr] = self.regs.get(addr, 0) + 1
+                    self.replies.append(bytes(self.codec.encode_writes(
+                        0, [self.regs.get(addr, 0) for addr in words[1:]])))
+
+        def recv(self, streamid):
+            return self.replies.pop(0)
+
+    csv = "\n".join([
+        "csr_register,ctrl_reset,0x00000000,1,rw",
+        "csr_register,trigger0_mode,0x00000004,1,rw",
+        "csr_register,trigger0_pre_trigger,0x00000008,2,rw",
+        "csr_register,trigger0_arm,0x00000010,1,rw",
+        "csr_register,trigger0_status,0x00000014,1,ro",
+        "csr_register,timebase_latch,0x00000018,1,rw",
+    ])
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    with os.fdopen(fd, "w") as f:
+        f.write(csv + "\n")
+    try:
+        for shadow in [False, True]:
+            device = Device({0x10, 0x14, 0x18})
+            eb = Etherbone(device, STREAMID_WISHBONE, csr_csv=path, shadow=shadow)
+            eb.regs.trigger0_mode.write(3)
+            eb.regs.trigger0_pre_trigger.write(0x123456789)
+            start = time.perf_counter()
+            for i in range(n):
+                assert eb.regs.trigger0_mode.read() == 3
+                assert eb.regs.trigger0_pre_trigger.read() == 0x123456789
+                # plain CSR strobes and status registers always go to the hardware
+                assert eb.regs.trigger0_arm.read() == i + 1
+                assert eb.regs.trigger0_status.read() == i + 1
+                assert eb.regs.timebase_latch.read() == i + 1
+            elapsed = time.perf_counter() - start
+            # a reset brings storage registers back to their defaults
+            eb.regs.ctrl_reset.write(1)
+            device.regs = {}
+            assert eb.regs.trigger0_mode.read() == 0
+            print("shadow {:5}: {:8.0f} reads/s, {} packets, {} shadow hits".format(
+                str(shadow), 5*n/elapsed, device.packets, eb.shadow_hits))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,139 @@
+import struct
+
+# same wire format as litex's EtherbonePacket and gateware/etherbone.py
+etherbone_magic = 0x4e6f
+etherbone_version = 1
+
+# maximum number of reads/writes in an etherbone record (8 bit rcount/wcount)
+max_count = 255
+
+# maximum payload words of the records chained in a packet, to fit the
+# gateware EtherboneRecordReceiver buffer
+max_packet_words = 256
+
+# magic, version/nr/pr/pf, addr_size/port_size, padding
+packet_header = struct.Struct(">HBBI")
+# flags, byte_enable, wcount, rcount
+record_header = struct.Struct(">BBBB")
+headers_length = packet_header.size + record_header.size
+
+_words = [struct.Struct(">{}I".format(n)) for n in range(max_count + 1)]
+
+
+class EtherboneCodec():
+    """Allocation-free etherbone packet encoder/decoder.
+
+    Encoded packets are built with struct.pack_into into reusable buffers
+    holding a precomputed packet and record header template, only counts
+    and words being patched for each packet. The returned memoryviews are
+    only valid until the next encode of the same kind.
+    """
+    def __init__(self, byte_enable=0xf):
+        self.byte_enable = byte_enable
+        size = headers_length + 4*(max_count + 1)
+        self.rbuf = bytearray(size)
+        self.wbuf = bytearray(size)
+        self.pbuf = bytearray(packet_header.size + (record_header.size + 4)*max_packet_words)
+        self.rview = memoryview(self.rbuf)
+        self.wview = memoryview(self.wbuf)
+        self.pview = memoryview(self.pbuf)
+        for buf in [self.rbuf, self.wbuf, self.pbuf]:
+            packet_header.pack_into(buf, 0, etherbone_magic, etherbone_version << 4,
+                                    (32//8 << 4) | 32//8, 0)
+        for buf in [self.rbuf, self.wbuf]:
+            record_header.pack_into(buf, packet_header.size, 0, byte_enable, 0, 0)
+
+    def encode_reads(self, addrs, base_ret_addr=0):
+        n = len(addrs)
+        self.rbuf[headers_length - 1] = n
+        _words[1].pack_into(self.rbuf, headers_length, base_ret_addr)
+        _words[n].pack_into(self.rbuf, headers_length + 4, *addrs)
+        return self.rview[:headers_length + 4*(n + 1)]
+
+    def encode_writes(self, base_addr, datas):
+        n = len(datas)
+        self.wbuf[headers_length - 2] = n
+        _words[1].pack_into(self.wbuf, headers_length, base_addr)
+        _words[n].pack_into(self.wbuf, headers_length + 4, *datas)
+        return self.wview[:headers_length + 4*(n + 1)]
+
+    def encode_write_records(self, bursts):
+        """Chain (base_addr, datas) write records in a single packet.
+
+        Each record costs len(datas) + 1 payload words, which must sum up to
+        at most max_packet_words.
+        """
+        offset = packet_header.size
+        for base_addr, datas in bursts:
+            n = len(datas)
+            record_header.pack_into(self.pbuf, offset, 0, self.byte_enable, n, 0)
+            _words[1].pack_into(self.pbuf, offset + record_header.size, base_addr)
+            _words[n].pack_into(self.pbuf, offset + record_header.size + 4, *datas)
+            offset += record_header.size + 4*(n + 1)
+        return self.pview[:offset]
+
+    def decode_writes(self, data):
+        """Return the datas of the write record replied to a read record."""
+        magic, = struct.unpack_from(">H", data, 0)
+        if magic != etherbone_magic:
+            raise ValueError("Bad etherbone magic {:04x}".format(magic))
+        n = data[headers_length - 2]
+        return _words[n].unpack_from(data, headers_length + 4)
+
+
+def bench(n=100000):
+    import time
+    from litex.soc.tools.remote.etherbone import (EtherbonePacket, EtherboneRecord,
+                                                  EtherboneReads, EtherboneWrites)
+
+    def litex_read():
+        record = EtherboneRecord()
+        record.reads = EtherboneReads(addrs=[0x1000])
+        record.rcount = 1
+        packet = EtherbonePacket()
+        packet.records = [record]
+        packet.encode()
+        return bytes(packet)
+
+    def litex_write():
+        record = EtherboneRecord()
+        record.writes = EtherboneWrites(base_addr=0x1000, datas=[0x12345678])
+        record.wcount = 1
+        packet = EtherbonePacket()
+        packet.records = [record]
+        packet.encode()
+        return bytes(packet)
+
+    reply = EtherbonePacket()
+    record = EtherboneRecord()
+    record.writes = EtherboneWrites(datas=[0x12345678])
+    record.wcount = 1
+    reply.records = [record]
+    reply.encode()
+    reply = bytes(reply)
+
+    def litex_decode():
+        packet = EtherbonePacket(reply)
+        packet.decode()
+        return packet.records.pop().writes.get_datas()
+
+    codec = EtherboneCodec()
+    tests = [
+        ("encode read",  litex_read,   lambda: codec.encode_reads((0x1000,)),              bytes),
+        ("encode write", litex_write,  lambda: codec.encode_writes(0x1000, (0x12345678,)), bytes),
+        ("decode reply", litex_decode, lambda: codec.decode_writes(reply),                 list),
+    ]
+    for name, ref, fast, conv in tests:
+        assert conv(ref()) == conv(fast())
+        rates = []
+        for fn in [ref, fast]:
+            start = time.perf_counter()
+            for i in range(n):
+                fn()
+            rates.append(n/(time.perf_counter() - start))
+        print("{:14s} litex: {:10.0f} ops/s  codec: {:10.0f} ops/s  ({:.1f}x)".format(
+            name, rates[0], rates[1], rates[1]/rates[0]))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,221 @@
+import numpy as np
+
+from iti_decoder import PAYLOAD_NONE, OVERFLOW_DIFF, start_pattern
+
+record_dtype = np.dtype([("timestamp", np.uint64), ("type", np.uint8), ("data", np.uint8)])
+
+# a record is at most 5 bytes: 1 header, 3 timestamp, 1 payload
+max_record_size = 5
+
+# steps given to the possible first records of a segment to converge
+converge_steps = 32
+
+# masks of the timestamp bytes following a header, by timestamp length
+_diff_masks = np.array([0, 0xff, 0xffff, 0xffffff], dtype=np.uint32)
+
+
+def _walk(sizes, pos, ends, mark=None):
+    """Advance all the cursors pos record by record until they reach ends.
+
+    Returns the first position of each cursor at or after its end. If
+    mark is given, the positions visited are set in it.
+    """
+    exits = pos.copy()
+    ids = np.flatnonzero(pos < ends)
+    p = pos[ids]
+    e = ends[ids]
+    while len(p):
+        if mark is not None:
+            mark[p] = True
+        p = p + sizes[p]
+        keep = p < e
+        if not keep.all():
+            exits[ids[~keep]] = p[~keep]
+            ids, p, e = ids[keep], p[keep], e[keep]
+    return exits
+
+
+def record_starts(buf, offset=0, segment_size=None):
+    """Return the offsets of the records of buf, the first one at offset.
+
+    Record boundaries depend on all the previous records, so buf is split
+    in segments walked in parallel. The first record of a segment is at one
+    of max_record_size offsets: the chains of records from these offsets
+    are first advanced until they meet, which takes a few records in
+    practice, then the common chain is walked to the end of the segment,
+    marking the record starts. The real first offset of each segment
+    follows from the exit offset of the previous one, and its records up
+    to the common chain are marked from the history of the convergence.
+    Segments whose chains do not meet are walked from each offset.
+
+    Returns (starts, end), end being the offset of the first incomplete
+    record (len(buf) if the last record is complete).
+    """
+    n = len(buf)
+    if n <= offset:
+        return np.empty(0, dtype=np.int64), offset
+    if segment_size is None:
+        # enough segments for numpy to amortize the per step overhead
+        segment_size = max(4096, n//8192)
+
+    # positions past the end of buf have size 1 so cursors always move
+    sizes = np.ones(n + max_record_size*(converge_steps + 1), dtype=np.uint8)
+    # 1 byte header + len bytes of timestamp + 1 byte of payload (if any),
+    # computed rather than looked up in iti_decoder.record_sizes (faster)
+    np.bitwise_and(buf >> 4, 3, out=sizes[:n])
+    sizes[:n] += (buf >> 6) != PAYLOAD_NONE
+    sizes[:n] += 1
+
+    seg_starts = np.arange(offset, n, segment_size, dtype=np.int64)
+    seg_ends = np.append(seg_starts[1:], n)
+    nseg = len(seg_starts)
+    segs = np.arange(nseg)
+
+    # advance the lagging chains of each segment until they all meet
+    cand = seg_starts[:, None] + np.arange(max_record_size)
+    history = np.empty((converge_steps, nseg, max_record_size), dtype=np.int64)
+    for i in range(converge_steps):
+        history[i] = cand
+        lag = cand == cand.min(axis=1, keepdims=True)
+        cand += np.where(lag, sizes[cand], 0)
+    meet = cand[:, 0]
+    merged = (cand == meet[:, None]).all(axis=1) & (meet < seg_ends)
+
+    # walk the common chains, marking their records
+    mark = np.zeros(len(sizes), dtype=bool)
+    exits = np.empty((nseg, max_record_size), dtype=np.int64)
+    exits[:] = _walk(sizes, meet, np.where(merged, seg_ends, 0), mark)[:, None]
+
+    # walk each chain of the other segments
+    other = np.flatnonzero(~merged)
+    if len(other):
+        starts = (seg_starts[other, None] + np.arange(max_record_size)).ravel()
+        ends = np.repeat(seg_ends[other], max_record_size)
+        exits[other] = _walk(sizes, starts, ends).reshape(-1, max_record_size)
+
+    # resolve the real first record offset of each segment
+    entries = np.empty(nseg, dtype=np.int64)
+    entry = offset
+    exits = exits.tolist()
+    for i, seg_start in enumerate(seg_starts.tolist()):
+        entries[i] = entry
+        entry = exits[i][entry - seg_start]
+
+    # mark the records before the common chains
+    prefix = history[:, segs, entries - seg_starts]
+    prefix = prefix[(prefix < meet) & merged]
+    mark[prefix] = True
+    _walk(sizes, entries[other], seg_ends[other], mark)
+
+    starts = np.flatnonzero(mark[:n])
+
+    # drop a truncated last record
+    end = n
+    if len(starts) and starts[-1] + sizes[starts[-1]] > n:
+        end = int(starts[-1])
+        starts = starts[:-1]
+    return starts, end
+
+
+def find_syncs(buf, start=0):
+    """Return the offsets of all the start patterns of buf at or after start.
+
+    The first byte of the pattern is searched in bulk, candidates are then
+    filtered on each of the following bytes.
+    """
+    pattern = np.frombuffer(start_pattern, dtype=np.uint8)
+    end = len(buf) - len(pattern) + 1
+    if end <= start:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.flatnonzero(buf[start:end] == pattern[0]) + start
+    for i in range(1, len(pattern)):
+        candidates = candidates[buf[candidates + i] == pattern[i]]
+    return candidates
+
+
+def decode(buf, offset=0, timestamp=0):
+    """Decode the records of an ITI capture buffer in bulk.
+
+    buf is a uint8 numpy array (e.g. numpy.frombuffer of a capture file),
+    its first record starting at offset. Returns (records, end) where
+    records is a record_dtype array of the same (timestamp, type, payload)
+    as ITIDecoder (payload 0 for PAYLOAD_NONE records) and end the offset
+    of the first incomplete record, or of the first invalid one (a
+    PAYLOAD_NONE record other than a time overflow: the alignment is lost,
+    ITIDecoder resyncs there).
+    """
+    buf = np.asarray(buf, dtype=np.uint8)
+    starts, end = record_starts(buf, offset)
+
+    # the 4 bytes following each position, as little endian words
+    padded = np.zeros(len(buf) + max_record_size, dtype=np.uint8)
+    padded[:len(buf)] = buf
+    words = np.ndarray((len(buf),), dtype="<u4", buffer=padded, offset=1, strides=(1,))
+
+    header = buf[starts]
+    following = words[starts]
+    length = (header >> 4) & 3
+    payload_type = header >> 6
+
+    diff = (header & 0xf) | ((following & _diff_masks[length]) << 4)
+    invalid = np.flatnonzero((payload_type == PAYLOAD_NONE) & (diff != OVERFLOW_DIFF))
+    if len(invalid):
+        first = invalid[0]
+        end = int(starts[first])
+        following, length, payload_type, diff = \
+            following[:first], length[:first], payload_type[:first], diff[:first]
+    data = (following >> (8*length).astype(np.uint32)).astype(np.uint8)
+    data[payload_type == PAYLOAD_NONE] = 0
+
+    timestamps = np.cumsum(diff.astype(np.uint64))
+    timestamps += np.uint64(timestamp)
+
+    records = np.empty(len(diff), dtype=record_dtype)
+    records["timestamp"] = timestamps
+    records["type"] = payload_type
+    records["data"] = data
+    return records, end
+
+
+def bench(n=10000000):
+    import time
+    from iti_decoder import ITIDecoder, encode_record, PAYLOAD_EVENT
+
+    # reference equivalence with the scalar decoder
+    rng = np.random.default_rng(0)
+    diffs = rng.choice([0, 1, 15, 16, 4095, 4096, 2**20, 2**28 - 1], 100000)
+    types = rng.integers(0, 4, 100000)
+    diffs[types == PAYLOAD_NONE] = OVERFLOW_DIFF
+    datas = rng.integers(0, 256, 100000)
+    raw = b"".join(encode_record(int(d), int(t), int(p)) for d, t, p in zip(diffs, types, datas))
+    raw += raw[:3] # truncated record
+    reference = ITIDecoder(timestamp=1000).decode(raw)
+    records, end = decode(np.frombuffer(raw, dtype=np.uint8), timestamp=1000)
+    assert end == len(raw) - 3
+    assert records.tolist() == [(ts, t, 0 if p is None else p) for ts, t, p in reference]
+
+    # decoding stops on an invalid record, where ITIDecoder loses the alignment
+    invalid = raw[:-3] + encode_record(5, PAYLOAD_NONE) + raw
+    records, end = decode(np.frombuffer(invalid, dtype=np.uint8), timestamp=1000)
+    assert end == len(raw) - 3 and len(records) == len(reference)
+
+    # dump opened at an arbitrary offset
+    dump = np.frombuffer(raw[7:1000] + start_pattern + raw, dtype=np.uint8)
+    syncs = find_syncs(dump)
+    assert syncs[0] == 993
+    records, end = decode(dump, offset=int(syncs[0]))
+    assert records["type"][:4].tolist() == [PAYLOAD_EVENT]*4
+
+    # typical capture: mostly data bytes with short time increments
+    pattern = np.frombuffer(b"".join(encode_record(d, t, 0x5a) for d, t in [
+        (1, 2), (1, 2), (1, 2), (20, 3), (1, 2), (300, 2), (0, 2), (5000, 3)]), dtype=np.uint8)
+    buf = np.tile(pattern, n//8)
+    start = time.perf_counter()
+    records, end = decode(buf)
+    elapsed = time.perf_counter() - start
+    print("{} records, {:.1f} M records/s, {:.1f} MB/s".format(
+        len(records), len(records)/elapsed/1e6, len(buf)/elapsed/1e6))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,236 @@
+# same values as gateware/iti.py
+PAYLOAD_NONE  = 0
+PAYLOAD_EVENT = 1
+PAYLOAD_DATA  = 2
+PAYLOAD_RXCMD = 3
+
+PAYLOAD_NAMES = ["NONE", "EVENT", "DATA", "RXCMD"]
+
+EVENT_START     = 0xe0
+EVENT_STOP      = 0xf1
+EVENT_TRIGGER   = 0xe2 # not an ITI1480A event
+EVENT_NAK_RUN   = 0xe3 # not an ITI1480A event, followed by 5 bytes of summary
+EVENT_TIME_SYNC = 0xe4 # not an ITI1480A event, followed by 6 bytes of time
+
+# events followed by payload bytes, sent as events
+EVENT_LENGTHS = {EVENT_NAK_RUN: 5, EVENT_TIME_SYNC: 6}
+
+# ITITime counts at 60 MHz
+ITI_CLOCK = 60e6
+
+# time increment of the PAYLOAD_NONE records sent on ITITime overflow
+OVERFLOW_DIFF = 2**28 - 1
+
+# ITICore sends ITIPattern(0xe00050, 3, 4) on start_pattern: 4 EVENT_START
+# records with no time increment, used to realign the decoding
+start_pattern = bytes([0x50, 0x00, EVENT_START])*4
+
+# record size in bytes for each header byte:
+# 1 byte header + len bytes of timestamp + 1 byte of payload (if any)
+record_sizes = bytes(1 + ((h >> 4) & 3) + ((h >> 6) != PAYLOAD_NONE) for h in range(256))
+
+
+def encode_record(diff, payload_type, payload=0):
+    """Return the bytes ITIPacker emits for a record (for testing)."""
+    if diff > 2**20 - 1:
+        length = 3
+    elif diff > 2**12 - 1:
+        length = 2
+    elif diff > 2**4 - 1:
+        length = 1
+    else:
+        length = 0
+    r = bytes([(diff & 0xf) | (length << 4) | (payload_type << 6)])
+    r += (diff >> 4).to_bytes(length, "little")
+    if payload_type != PAYLOAD_NONE:
+        r += bytes([payload])
+    return r
+
+
+def find_sync(data, start=0):
+    """Return the offset of the first start pattern of data at or after
+    start, or -1. data can be any buffer with a find method (bytes,
+    bytearray, mmap of a capture file).
+    """
+    return data.find(start_pattern, start)
+
+
+def find_alignment(data, start=0):
+    """Return the offset of the first record boundary at or after start
+    when data starts at an unknown position of a record stream (e.g. a
+    triggered capture), or -1 if data is too short to tell.
+
+    The first boundary is one of the next record_size offsets: the chains
+    of records from each of them are followed until they meet, the meeting
+    point being on the real chain.
+    """
+    sizes = record_sizes
+    candidates = list(range(start, start + 5))
+    while candidates[-1] < len(data):
+        first = min(candidates)
+        if first == max(candidates):
+            return first
+        candidates = sorted(c + sizes[data[c]] if c == first else c for c in candidates)
+    return -1
+
+
+class ITIDecoder():
+    """Streaming decoder of the records of an ITI capture stream.
+
+    The gateware (ITIPacker + Conv4032) sends variable length records back
+    to back, each made of a header byte (time increment bits 0-3, number of
+    extra timestamp bytes, payload type), 0 to 3 bytes of time increment
+    bits 4-27 and a payload byte (except for PAYLOAD_NONE/overflow records).
+
+    decode() can be fed chunks of any size: an incomplete record at the end
+    of a chunk is kept and completed by the next one. Time increments are
+    accumulated in timestamp, in 60 MHz ticks since the first record.
+    Records are returned as (timestamp, payload_type, payload) tuples,
+    payload being None for PAYLOAD_NONE records.
+
+    When not synced (synced=False, after resync() or when a PAYLOAD_NONE
+    record other than an overflow reveals a misalignment), data is skipped
+    up to the next start pattern. Skipped bytes are counted in skipped, the
+    time elapsed while unsynced is lost.
+    """
+    def __init__(self, timestamp=0, synced=True):
+        self.timestamp = timestamp
+        self.pending = b""
+        self.records = 0
+        self.synced = synced
+        self.resyncs = 0
+        self.skipped = 0
+
+    def resync(self):
+        """Drop the pending data and wait for the next start pattern,
+        e.g. after flushing the capture FIFOs."""
+        self.skipped += len(self.pending)
+        self.pending = b""
+        self.synced = False
+
+    def _sync(self, data, i):
+        start = find_sync(data, i)
+        if start < 0:
+            # keep a possibly truncated pattern at the end of data
+            start = max(i, len(data) - (len(start_pattern) - 1))
+        else:
+            self.synced = True
+        self.skipped += start - i
+        return start
+
+    def decode(self, data):
+        """Decode a chunk and return the list of its complete records."""
+        if self.pending:
+            data = self.pending + data
+        n = len(data)
+        sizes = record_sizes
+        ts = self.timestamp
+        records = []
+        append = records.append
+
+        i = 0
+        if not self.synced:
+            i = self._sync(data, i)
+        while self.synced and i < n:
+            h = data[i]
+            size = sizes[h]
+            if i + size > n:
+                break
+            length = (h >> 4) & 3
+            diff = h & 0xf
+            if length:
+                diff |= data[i + 1] << 4
+                if length > 1:
+                    diff |= data[i + 2] << 12
+                    if length > 2:
+                        diff |= data[i + 3] << 20
+            ts += diff
+            payload_type = h >> 6
+            if payload_type:
+                append((ts, payload_type, data[i + 1 + length]))
+            elif diff == OVERFLOW_DIFF:
+                append((ts, PAYLOAD_NONE, None))
+            else:
+                # not a record, we lost the alignment
+                ts -= diff
+                self.synced = False
+                self.resyncs += 1
+                i = self._sync(data, i + 1)
+                continue
+            i += size
+
+        self.pending = bytes(data[i:])
+        self.timestamp = ts
+        self.records += len(records)
+        return records
+
+
+def iti_records(chunks, decoder=None):
+    """Yield the records decoded from an iterable of capture chunks."""
+    if decoder is None:
+        decoder = ITIDecoder()
+    for chunk in chunks:
+        yield from decoder.decode(chunk)
+
+
+def format_record(record):
+    ts, payload_type, payload = record
+    if payload is None:
+        return "{:14.9f} {:5s}".format(ts/ITI_CLOCK, PAYLOAD_NAMES[payload_type])
+    return "{:14.9f} {:5s} {:02x}".format(ts/ITI_CLOCK, PAYLOAD_NAMES[payload_type], payload)
+
+
+def bench(n=1000000, chunk_size=64*1024):
+    import random
+    import time
+
+    random.seed(0)
+    reference = []
+    raw = bytearray()
+    ts = 0
+    for i in range(n):
+        diff = random.choice([0, 1, 15, 16, 4095, 4096, 2**20, 2**28 - 1])
+        payload_type = random.choice([PAYLOAD_NONE, PAYLOAD_EVENT, PAYLOAD_DATA, PAYLOAD_RXCMD])
+        if payload_type == PAYLOAD_NONE:
+            diff = OVERFLOW_DIFF
+        payload = None if payload_type == PAYLOAD_NONE else random.randrange(256)
+        ts += diff
+        reference.append((ts, payload_type, payload))
+        raw += encode_record(diff, payload_type, payload or 0)
+    raw = bytes(raw)
+
+    # odd chunk sizes to exercise records split across chunks
+    decoded = list(iti_records(raw[i:i + 4093] for i in range(0, len(raw), 4093)))
+    assert decoded == reference
+
+    # garbage before the start pattern, then a misaligned stream
+    decoder = ITIDecoder(synced=False)
+    garbage = bytes([0x01, 0x30, 0x00, 0x50, 0x00])
+    resynced = garbage + start_pattern + raw[:1000] + raw[1:1000] + start_pattern + raw[:1000]
+    decoded = list(iti_records((resynced[i:i + 7] for i in range(0, len(resynced), 7)), decoder))
+    assert decoded[:4] == [(0, PAYLOAD_EVENT, EVENT_START)]*4
+    assert decoder.synced and decoder.resyncs == 1
+    assert decoder.skipped >= len(garbage) + 1
+
+    # capture starting in the middle of a record
+    boundaries = set()
+    offset = previous = 0
+    for ts, payload_type, payload in reference[:1000]:
+        boundaries.add(offset)
+        offset += len(encode_record(ts - previous, payload_type))
+        previous = ts
+    for i in range(100):
+        assert find_alignment(raw, i) in boundaries
+
+    start = time.perf_counter()
+    count = 0
+    for records in map(ITIDecoder().decode,
+                       (raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size))):
+        count += len(records)
+    elapsed = time.perf_counter() - start
+    print("{} records, {:.2f} M records/s, {:.2f} MB/s".format(
+        count, count/elapsed/1e6, len(raw)/elapsed/1e6))
+
+
+if __name__ == "__main__":
+    bench()
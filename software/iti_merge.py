@@ -0,0 +1,160 @@
+import heapq
+import operator
+import collections
+
+from iti_decoder import PAYLOAD_EVENT, EVENT_TIME_SYNC, EVENT_LENGTHS
+
+
+class TimeAligner():
+    """Convert the timestamps of the records of a stream to the time of the
+    gateware timebase (ITITimebase), shared by all the channels.
+
+    The ITI cores send an EVENT_TIME_SYNC followed by the 6 bytes of the
+    time of its record every millisecond (ITISync). decode() takes the
+    records of ITIDecoder.decode() and returns them with timebase
+    timestamps, the sync records removed. Each sync sets the offset from
+    the stream timestamps: records are kept until the first one (at most
+    max_pending, older ones are dropped and counted in dropped), the next
+    ones use the last offset.
+
+    The decoding can start anywhere in a stream (e.g. at a capture file
+    index entry), the time is known from the first sync.
+    """
+    def __init__(self, max_pending=1000000):
+        self.max_pending = max_pending
+        self.offset = None
+        self.sync = None
+        self.event_left = 0
+        self.pending = collections.deque(maxlen=max_pending)
+        self.syncs = 0
+        self.dropped = 0
+
+    def _synced(self, sync):
+        self.offset = int.from_bytes(bytes(sync[1:]), "little") - sync[0]
+        self.syncs += 1
+        offset = self.offset
+        out = [(ts + offset, payload_type, payload) for ts, payload_type, payload in self.pending]
+        self.pending.clear()
+        return out
+
+    def decode(self, records):
+        out = []
+        append = out.append
+        offset = self.offset
+        for record in records:
+            ts, payload_type, payload = record
+            if payload_type == PAYLOAD_EVENT:
+                if self.sync is not None:
+                    self.sync.append(payload)
+                    if len(self.sync) == 1 + EVENT_LENGTHS[EVENT_TIME_SYNC]:
+                        out += self._synced(self.sync)
+                        offset = self.offset
+                        self.sync = None
+                    continue
+                if self.event_left:
+                    # payload of a multi-byte event (e.g. a NAK run), whatever its value
+                    self.event_left -= 1
+                elif payload == EVENT_TIME_SYNC:
+                    self.sync = [ts]
+                    continue
+                else:
+                    self.event_left = EVENT_LENGTHS.get(payload, 0)
+            if offset is None or self.sync is not None:
+                # time not known yet
+                if len(self.pending) == self.max_pending:
+                    self.dropped += 1
+                self.pending.append(record)
+            else:
+                append((ts + offset, payload_type, payload))
+        return out
+
+
+def aligned_records(chunks, aligner=None):
+    """Yield the records of an iterable of lists of ITI records (as returned
+    by ITIDecoder.decode) with timebase timestamps."""
+    if aligner is None:
+        aligner = TimeAligner()
+    for records in chunks:
+        yield from aligner.decode(records)
+
+
+def merge(*streams):
+    """Merge the aligned records of several channels (iterables of records
+    as returned by aligned_records()) in one timeline.
+
+    Yields (timestamp, channel, payload_type, payload) tuples in timestamp
+    order, the records of a channel in their order and ties between
+    channels in channel order.
+    """
+    def channel(i, records):
+        for ts, payload_type, payload in records:
+            yield ts, i, payload_type, payload
+    return heapq.merge(*(channel(i, s) for i, s in enumerate(streams)),
+                       key=operator.itemgetter(0))
+
+
+def bench(n=200000):
+    import time
+    import random
+    from iti_decoder import ITIDecoder, encode_record, PAYLOAD_DATA, PAYLOAD_RXCMD, EVENT_NAK_RUN
+
+    random.seed(0)
+    period = 60000
+
+    # records of 2 channels at timebase times, a sync every period, the data
+    # records sent while the sync bytes wait being interleaved
+    def channel(start):
+        records = []
+        syncs = []
+        ts = start
+        next_sync = start + random.randrange(period)
+        for i in range(n):
+            ts += random.choice([0, 1, 2, 10, 1000, 20000])
+            if ts >= next_sync:
+                sync = next_sync
+                syncs.append(sync)
+                records.append((sync, PAYLOAD_EVENT, EVENT_TIME_SYNC))
+                records += [(sync + 2 + 2*j, PAYLOAD_EVENT, b) for j, b in enumerate(sync.to_bytes(6, "little"))]
+                next_sync += period
+            records.append((ts, random.choice([PAYLOAD_DATA, PAYLOAD_RXCMD]), random.randrange(256)))
+        records.sort(key=lambda r: (r[0], r[1] != PAYLOAD_EVENT))
+        raw = []
+        last = records[0][0]
+        for ts, payload_type, payload in records:
+            raw.append(encode_record(ts - last, payload_type, payload))
+            last = ts
+        return records, raw, syncs
+
+    streams = []
+    reference = []
+    for i, start in enumerate([1000, 2**40 + 12345]):
+        records, raw, syncs = channel(start)
+        first = 0
+        if i == 1:
+            # decode channel 1 from the middle of its stream, after a sync
+            sync = syncs[len(syncs)//2]
+            first = records.index((sync + 12, PAYLOAD_EVENT, sync >> 40)) + 1
+        decoder = ITIDecoder()
+        chunks = [decoder.decode(b"".join(raw[j:j + 4093])) for j in range(first, len(raw), 4093)]
+        streams.append(aligned_records(chunks))
+        reference += [(ts, i, payload_type, payload) for ts, payload_type, payload in records[first:]
+                      if payload_type != PAYLOAD_EVENT]
+    reference.sort(key=lambda r: r[0:2])
+
+    start = time.perf_counter()
+    merged = list(merge(*streams))
+    elapsed = time.perf_counter() - start
+    assert merged == reference
+    print("{} records, {:.2f} M records/s".format(len(merged), len(merged)/elapsed/1e6))
+
+    # EVENT_TIME_SYNC bytes in the payload of a NAK run are not syncs
+    aligner = TimeAligner()
+    sync = [(100, PAYLOAD_EVENT, b) for b in bytes([EVENT_TIME_SYNC]) + (5000).to_bytes(6, "little")]
+    run = [(200, PAYLOAD_EVENT, b) for b in [EVENT_NAK_RUN, EVENT_TIME_SYNC, 0, EVENT_TIME_SYNC, 1, 0]]
+    data = [(300, PAYLOAD_DATA, 0x5a)]
+    assert aligner.decode(sync + run + data) == [(ts + 4900, t, p) for ts, t, p in run + data]
+    assert aligner.syncs == 1
+
+
+if __name__ == "__main__":
+    bench()
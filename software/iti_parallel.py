@@ -0,0 +1,245 @@
+import os
+import mmap
+import multiprocessing
+
+import numpy as np
+
+import iti_bulk
+from iti_decoder import encode_record, record_sizes, start_pattern, OVERFLOW_DIFF, PAYLOAD_NONE
+from capture_file import CaptureFile
+
+# bytes of the PAYLOAD_NONE record sent on ITITime overflow
+overflow_record = encode_record(OVERFLOW_DIFF, PAYLOAD_NONE)
+
+
+def resync_points(buf, start=0, end=None, segment_size=16*1024*1024):
+    """Return the offsets where to split buf in segments of about
+    segment_size bytes, start included.
+
+    A segment starts on the first start pattern or overflow record found
+    after each multiple of segment_size. These bytes can also appear in
+    the middle of records, the boundaries are checked when decoding.
+    buf is any buffer with a find method (bytes, mmap).
+    """
+    end = len(buf) if end is None else end
+    points = [start]
+    for target in range(start + segment_size, end, segment_size):
+        if target <= points[-1]:
+            continue
+        found = [p for p in (buf.find(start_pattern, target, end),
+                             buf.find(overflow_record, target, end)) if p >= 0]
+        if not found:
+            break
+        points.append(min(found))
+    return points
+
+
+def _decode(task):
+    """Decode the bytes start to end of a file, timestamps relative to start."""
+    path, start, end = task
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buf = np.frombuffer(mm, dtype=np.uint8, count=end - start, offset=start)
+        records, stop = iti_bulk.decode(buf)
+        del buf
+    return records, stop
+
+
+class ParallelDecoder():
+    """Decode segments of a file with a pool of processes.
+
+    decode() takes the offsets where to split the bytes start to end of
+    the file, the first one being a record start if synced. Each process
+    decodes its segments with iti_bulk from a shared mmap of the file, with
+    timestamps relative to the segment start. Segments are yielded in order
+    as record_dtype arrays, their timestamps offset by the last record of
+    the previous one (timestamp for the first one).
+
+    A boundary found inside a record is detected by the previous segment
+    not ending on it, the segment is then decoded again from the end of the
+    previous one. As ITIDecoder, the decoding stops on invalid records (the
+    alignment is lost, counted in resyncs) and resumes from the next start
+    pattern. The bytes not decoded (skipped until a start pattern,
+    truncated last record) are counted in skipped.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.resyncs = 0
+        self.skipped = 0
+
+    def decode(self, path, points, end, timestamp=0, synced=True):
+        tasks = [(path, start, stop) for start, stop in zip(points, points[1:] + [end])]
+        pool = None
+        if self.processes != 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.imap(_decode, tasks) if pool else map(_decode, tasks)
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # offset of the next record, None when searching a start pattern
+                pos = points[0] if synced else None
+                search = points[0]
+                for (path, start, stop), result in zip(tasks, results):
+                    while True:
+                        if pos is None:
+                            found = mm.find(start_pattern, search, min(stop + len(start_pattern) - 1, end))
+                            if found < 0:
+                                self.skipped += stop - search
+                                search = stop
+                                break
+                            self.skipped += found - search
+                            pos = found
+                        if pos != start:
+                            result = _decode((path, pos, stop))
+                        records, last = result
+                        records["timestamp"] += np.uint64(timestamp)
+                        if len(records):
+                            timestamp = int(records["timestamp"][-1])
+                            yield records
+                        pos += last
+                        if pos == stop:
+                            break
+                        if pos + record_sizes[mm[pos]] > stop:
+                            # the last record continues in the next segment
+                            if stop == end:
+                                self.skipped += end - pos
+                            break
+                        # not a record: wait for the next start pattern
+                        self.resyncs += 1
+                        search = pos + 1
+                        pos = None
+        finally:
+            if pool:
+                pool.terminate()
+
+
+def decode_file(path, offset=0, end=None, timestamp=0, processes=None,
+                segment_size=16*1024*1024, decoder=None):
+    """Decode a raw capture dump with a pool of processes (see
+    ParallelDecoder).
+
+    The dump is split at resync points (see resync_points()), the first
+    record starting at offset.
+
+    Records are only split on start patterns and overflow records: a
+    capture without pauses long enough to overflow ITITime is decoded in
+    one segment, use a capture file (decode_capture()) for those.
+    """
+    if decoder is None:
+        decoder = ParallelDecoder(processes)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        end = len(mm) if end is None else end
+        points = resync_points(mm, offset, end, segment_size)
+    yield from decoder.decode(path, points, end, timestamp)
+
+
+def decode_capture(path, processes=None, segment_size=16*1024*1024, decoder=None):
+    """Decode a capture file (see capture_file) with a pool of processes.
+
+    Like decode_file(), but segments are split on the record boundaries of
+    the capture file index, every segment_size bytes. Only the chunks the
+    capture was synced at are used, the decoding resyncs in the others.
+    """
+    if decoder is None:
+        decoder = ParallelDecoder(processes)
+    capture = CaptureFile(path)
+    try:
+        index = capture.index
+        end = capture.data_end
+    finally:
+        capture.close()
+    if not index:
+        return
+    points = [index[0].offset + index[0].align]
+    for entry in index[1:]:
+        if entry.synced and entry.offset + entry.align - points[-1] >= segment_size:
+            points.append(entry.offset + entry.align)
+    yield from decoder.decode(path, points, end, index[0].timestamp, index[0].synced)
+
+
+def bench(n=20000000):
+    import time
+    import tempfile
+    from iti_decoder import ITIDecoder, PAYLOAD_DATA, PAYLOAD_RXCMD
+    from capture_file import CaptureWriter
+
+    fd, path = tempfile.mkstemp(suffix=".bin")
+    os.close(fd)
+    try:
+        # overflow records, and the same bytes in the middle of records
+        # (DATA 0x3f followed by an RXCMD with a 3 bytes time increment)
+        rng = np.random.default_rng(0)
+        records = [encode_record(d, PAYLOAD_DATA, p) for d, p in
+                   zip(rng.choice([1, 20, 5000], 50000).tolist(), rng.integers(0, 256, 50000).tolist())]
+        for i in rng.integers(0, len(records), 500).tolist():
+            records[i] = overflow_record
+        for i in rng.integers(0, len(records), 2000).tolist():
+            records[i] = encode_record(1, PAYLOAD_DATA, 0x3f) + encode_record(2**28 - 1, PAYLOAD_RXCMD, 1)
+        raw = b"".join(records)
+        with open(path, "wb") as f:
+            f.write(raw)
+        reference, _ = iti_bulk.decode(np.frombuffer(raw, dtype=np.uint8), timestamp=100)
+        for processes in [1, 2]:
+            segments = list(decode_file(path, timestamp=100, processes=processes, segment_size=997))
+            assert len(segments) > 1
+            assert np.array_equal(np.concatenate(segments), reference)
+
+        # capture file, split on its index
+        writer = CaptureWriter(path, chunk_size=4093, decoder=ITIDecoder(timestamp=100))
+        writer.write(raw)
+        writer.close()
+        segments = list(decode_capture(path, processes=2, segment_size=10000))
+        assert len(segments) > 1
+        assert np.array_equal(np.concatenate(segments), reference)
+
+        # invalid bytes in the middle of the dump and a truncated last
+        # record: the records and counters of ITIDecoder
+        junk = encode_record(5, PAYLOAD_NONE) + bytes(range(256))*20
+        raw = b"".join(records[:20000] + [junk, start_pattern] + records[20000:] + [records[0][:1]])
+        with open(path, "wb") as f:
+            f.write(raw)
+        scalar = ITIDecoder(timestamp=100)
+        reference = [(ts, t, 0 if p is None else p) for ts, t, p in scalar.decode(raw)]
+        decoder = ParallelDecoder(processes=2)
+        segments = list(decode_file(path, timestamp=100, segment_size=997, decoder=decoder))
+        assert np.concatenate(segments).tolist() == reference
+        assert decoder.resyncs == scalar.resyncs == 1
+        assert decoder.skipped == scalar.skipped + len(scalar.pending)
+
+        # capture file started out of sync (sniff.py): the unsynced chunks
+        # are not split on
+        raw = junk + start_pattern + raw
+        writer = CaptureWriter(path, chunk_size=4093, decoder=ITIDecoder(synced=False))
+        writer.write(raw)
+        writer.close()
+        scalar = ITIDecoder(synced=False)
+        reference = [(ts, t, 0 if p is None else p) for ts, t, p in scalar.decode(raw)]
+        decoder = ParallelDecoder(processes=2)
+        segments = list(decode_capture(path, segment_size=10000, decoder=decoder))
+        assert len(segments) > 1
+        assert np.concatenate(segments).tolist() == reference
+        assert decoder.resyncs == scalar.resyncs
+        assert decoder.skipped == scalar.skipped + len(scalar.pending)
+
+        # typical capture, an overflow record every 64k records
+        pattern = b"".join(encode_record(d, t, 0x5a) for d, t in [
+            (1, 2), (1, 2), (1, 2), (20, 3), (1, 2), (300, 2), (0, 2), (5000, 3)])
+        block = pattern*8191 + overflow_record*8
+        with open(path, "wb") as f:
+            for i in range(n//(8*8192)):
+                f.write(block)
+
+        cpus = os.cpu_count() or 1
+        base = None
+        for processes in sorted({1, 2, cpus//2, cpus} - {0}):
+            start = time.perf_counter()
+            count = sum(len(r) for r in decode_file(path, processes=processes,
+                                                    segment_size=4*1024*1024))
+            elapsed = time.perf_counter() - start
+            base = base or elapsed
+            print("{:3d} processes: {} records, {:.1f} M records/s, speedup {:.2f}, efficiency {:.0f}%".format(
+                processes, count, count/elapsed/1e6, base/elapsed, 100*base/elapsed/processes))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
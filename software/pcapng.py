@@ -0,0 +1,180 @@
+import time
+import struct
+
+from iti_decoder import ITIDecoder
+from usb_packets import USBPacket, USBPacketDecoder
+
+LINKTYPE_USB_2_0 = 288
+
+BLOCK_SHB = 0x0a0d0d0a # section header
+BLOCK_IDB = 0x00000001 # interface description
+BLOCK_EPB = 0x00000006 # enhanced packet
+
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+OPT_ENDOFOPT = 0
+OPT_IF_TSRESOL = 9
+
+# type, total length, interface, timestamp high/low, captured/original length
+epb_header = struct.Struct("<IIIIIII")
+
+# struct formats of the enhanced packet blocks by packet length: header,
+# data padded to 32 bits, total length
+epb_formats = {}
+
+
+def _epb_format(n):
+    fmt = epb_formats[n] = "7I{}sI".format(n + (-n & 3))
+    return fmt
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+class PcapngWriter():
+    """Write USBPackets to a pcapng file with the USB 2.0 link type.
+
+    Timestamps are in nanoseconds: ITI timestamps (60 MHz ticks) are
+    converted and offset by start_ns, the capture start time (now by
+    default). Blocks are packed in a buffer of buffer_size bytes, written
+    when full, call flush() or close() to write the remaining ones.
+    """
+    def __init__(self, f, start_ns=None, snaplen=2048, buffer_size=1024*1024):
+        self.f = f
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.buf = bytearray(buffer_size)
+        self.offset = 0
+        self.packets = 0
+        self.bytes = 0
+
+        # section header: magic, version 1.0, unknown section length
+        self._append(_block(BLOCK_SHB, struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1)))
+        # interface with nanosecond timestamps
+        options = struct.pack("<HHB3x", OPT_IF_TSRESOL, 1, 9) + struct.pack("<HH", OPT_ENDOFOPT, 0)
+        self._append(_block(BLOCK_IDB, struct.pack("<HHI", LINKTYPE_USB_2_0, 0, snaplen) + options))
+
+    def _reserve(self, size):
+        if self.offset + size > len(self.buf):
+            self.flush()
+            if size > len(self.buf):
+                self.buf = bytearray(size)
+        offset = self.offset
+        self.offset += size
+        return offset
+
+    def _append(self, data):
+        offset = self._reserve(len(data))
+        self.buf[offset:offset + len(data)] = data
+
+    def write(self, packets):
+        """Write the USBPackets of packets, ignoring other objects.
+
+        The blocks of all the packets are packed at once: the per packet
+        work is limited to gathering the fields.
+        """
+        packets = [packet for packet in packets if type(packet) is USBPacket]
+        if not packets:
+            return
+        formats = epb_formats
+        fmt = ["<"]
+        args = []
+        extend = args.extend
+        start_ns = self.start_ns
+        for start, end, pid, data, status in packets:
+            n = len(data)
+            fmt.append(formats.get(n) or _epb_format(n))
+            length = 32 + n + (-n & 3)
+            ts = start_ns + start*50//3 # 60 MHz ticks to ns
+            extend((BLOCK_EPB, length, 0, ts >> 32, ts & 0xffffffff, n, n, data, length))
+        fmt = "".join(fmt)
+        offset = self._reserve(struct.calcsize(fmt))
+        struct.pack_into(fmt, self.buf, offset, *args)
+        self.packets += len(packets)
+
+    def flush(self):
+        self.f.write(memoryview(self.buf)[:self.offset])
+        self.bytes += self.offset
+        self.offset = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def capture(io, streamid, path, decoder=None, duration=None):
+    """Write the packets received on streamid of a USBMux/USBDemux to a
+    pcapng file, until EOF or duration seconds."""
+    if decoder is None:
+        decoder = ITIDecoder(synced=False)
+    packets = USBPacketDecoder(rxcmds=False)
+    writer = PcapngWriter(open(path, "wb"))
+    deadline = None if duration is None else time.monotonic() + duration
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                data = io.recv(streamid)
+            except EOFError:
+                break
+            if data is not None:
+                writer.write(packets.decode(decoder.decode(data)))
+        writer.write(packets.flush())
+    finally:
+        writer.close()
+    return writer
+
+
+def bench(n=1000000):
+    import os
+    import tempfile
+    from usb_packets import encode_token, encode_data, PID_IN, PID_DATA0, STATUS_OK
+
+    datas = [encode_token(PID_IN, 0x81), encode_data(PID_DATA0, bytes(range(64))), bytes([0xd2])]
+    packets = [USBPacket(10*i, 10*i + 1, datas[i % 3][0] & 0xf, datas[i % 3], STATUS_OK)
+               for i in range(n)]
+
+    fd, path = tempfile.mkstemp(suffix=".pcapng")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        writer = PcapngWriter(open(path, "wb"), start_ns=0)
+        for i in range(0, n, 4096):
+            writer.write(packets[i:i + 4096])
+        writer.close()
+        elapsed = time.perf_counter() - start
+
+        # read back the first packets
+        with open(path, "rb") as f:
+            data = f.read(4096)
+        offset = 0
+        blocks = []
+        while offset < len(data) - 12:
+            block_type, length = struct.unpack_from("<II", data, offset)
+            blocks.append((block_type, data[offset:offset + length]))
+            offset += length
+        assert [t for t, b in blocks[:3]] == [BLOCK_SHB, BLOCK_IDB, BLOCK_EPB]
+        _, _, _, ts_high, ts_low, caplen, _ = epb_header.unpack_from(blocks[3][1])
+        assert ts_low == 10*50//3 and blocks[3][1][28:28 + caplen] == datas[1]
+
+        print("{} packets, {:.0f} packets/s, {:.1f} MB/s".format(
+            n, n/elapsed, writer.bytes/elapsed/1e6))
+
+        # the cost is per packet: high speed bulk packets, in batches larger
+        # than the buffer
+        bulk = USBPacket(0, 1, PID_DATA0, encode_data(PID_DATA0, bytes(512)), STATUS_OK)
+        start = time.perf_counter()
+        writer = PcapngWriter(open(path, "wb"), start_ns=0)
+        for i in range(0, n//4, 4096):
+            writer.write([bulk]*4096)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        assert os.path.getsize(path) == writer.bytes
+        print("{} bulk packets, {:.0f} packets/s, {:.1f} MB/s".format(
+            writer.packets, writer.packets/elapsed, writer.bytes/elapsed/1e6))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
@@ -3,7 +3,13 @@ import time
 
 from sdram_init import *
 
-from etherbone import Etherbone, USBMux
+from etherbone import Etherbone, USBMux, USBDemux
+from etherbone import STREAMID_WISHBONE, STREAMID_ULPI0
+from iti_decoder import ITIDecoder
+from usb_packets import USBPacketDecoder, usb_packets
+from usb_collapse import IdleCollapser, collapse_idle, format_item
+from pcapng import capture
+from capture_file import record
 from gateware.ulpi import ULPIFilter
 
 def sdram_configure(wb):
@@ -104,40 +110,54 @@ def ulpi_init(eb, num):
     ulpi_write_reg(eb, num, 0x12, 0x1f) # clear interrupt falling
     ulpi_write_reg(eb, num, 0x04, 0b01001000)
 
-STREAMID_WISHBONE = 0
-STREAMID_ULPI0 = 1
-STREAMID_ULPI1 = 2
-
-def lt_unpack(eb, data):
-    print(data.hex())
-    length = int.from_bytes(data[0:4], "little")
-    ts = int.from_bytes(data[4:12], "little")
-    payload = data[12:12+length]
-    print("({}, {}): {}".format(ts, length, payload.hex()))
+def capture_metadata(eb, identifier):
+    # host time and gateware timebase at the same moment
+    eb.regs.timebase_latch.write(1)
+    return {
+        "identifier": identifier,
+        "time": time.time(),
+        "timebase": eb.regs.timebase_latched.read(),
+        "csr": {name: reg.read() for name, reg in eb.regs.d.items() if reg.mode == "rw"},
+        "ulpi": [[ulpi_read_reg(eb, num, i) for i in range(0x19)] for num in range(2)],
+    }
 
 if __name__ == '__main__':
+    drop_sof = "--drop-sof" in sys.argv
+    if drop_sof:
+        sys.argv.remove("--drop-sof")
     if len(sys.argv) < 2:
-        print("usage: {} /dev/ft60xx".format(sys.argv[0]))
+        print("usage: {} [--drop-sof] /dev/ft60xx [capture.pcapng|capture.usbsniff]".format(sys.argv[0]))
         sys.exit(1)
 
     usbmux = USBMux(sys.argv[1])
-    eb = Etherbone(usbmux, STREAMID_WISHBONE,
-                          csr_csv="test/csr.csv")
+    demux = USBDemux(usbmux)
+    eb = Etherbone(demux, STREAMID_WISHBONE,
+                          csr_csv="test/csr.csv", shadow=True)
 
+    eb.write_behind = True
     sdram_configure(eb)
+    eb.flush()
+    eb.write_behind = False
 
     print("Testing SRAM write/read:")
-    for i in range(32):
-        eb.write(eb.mems.sram.base + 4*i, i)
-        print("%08x" %eb.read(eb.mems.sram.base + 4*i))
+    eb.write(eb.mems.sram.base, list(range(32)))
+    for data in eb.read_block(eb.mems.sram.base, 32):
+        print("%08x" %data)
 
     identifier = ""
-    for i in range(0, 32):
-        identifier += "%c" %eb.read(eb.bases.identifier_mem + 4*i)
+    for c in eb.read_block(eb.bases.identifier_mem, 32):
+        identifier += "%c" %c
     print("\nSoC identifier: " + identifier)
     print()
 
-    # eb.regs.ulpi_filter_mask.write(ULPIFilter.SOF)
+    # drop the SOF packets in the gateware on request, idle periods then
+    # show up as line events only
+    if drop_sof:
+        eb.regs.ulpi_filter0_mask.write(ULPIFilter.SOF)
+        eb.regs.ulpi_filter1_mask.write(ULPIFilter.SOF)
+    # replace the repeated IN / NAK exchanges by summaries
+    eb.regs.nak_compressor0_enable.write(1)
+    eb.regs.nak_compressor1_enable.write(1)
 
     eb.regs.ulpi_sw_oe_n_out.write(0)
     eb.regs.ulpi_sw_s_out.write(0)
@@ -150,7 +170,23 @@ if __name__ == '__main__':
     ulpi_init(eb, 1)
     print()
 
+    # ULPI register reads flush the captured data, read them first
+    metadata = capture_metadata(eb, identifier)
+
     print("Waiting for ULPI0 data:")
-    while True:
-        data = usbmux.recv(STREAMID_ULPI0)
-        lt_unpack(eb, data)
+    # align the decoding on a start pattern
+    decoder = ITIDecoder(synced=False)
+    eb.regs.iticore0_start_pattern.write(1)
+    if len(sys.argv) > 2 and sys.argv[2].endswith(".pcapng"):
+        writer = capture(demux, STREAMID_ULPI0, sys.argv[2], decoder)
+        print("{} packets written to {}".format(writer.packets, sys.argv[2]))
+        sys.exit(0)
+    elif len(sys.argv) > 2:
+        writer = record(demux, STREAMID_ULPI0, sys.argv[2], metadata, decoder)
+        print("{} records written to {}".format(writer.records, sys.argv[2]))
+        sys.exit(0)
+    chunks = iter(lambda: demux.recv(STREAMID_ULPI0), None)
+    packets = usb_packets(map(decoder.decode, chunks), USBPacketDecoder())
+    # print idle periods as one line per second of high speed SOFs
+    for item in collapse_idle(packets, IdleCollapser(max_count=8000)):
+        print(format_item(item))
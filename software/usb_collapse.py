@@ -0,0 +1,267 @@
+import heapq
+import itertools
+import array
+import collections
+
+from iti_decoder import ITI_CLOCK
+from usb_packets import (USBPacket, LineEvent, NAKRun, STATUS_OK, PID_SOF, RXCMD_LINESTATE,
+                         encode_token, format_packet)
+
+SOFRun = collections.namedtuple("SOFRun", "start end first last count starts durations frames")
+SOFRun.__doc__ = """Consecutive valid SOF packets.
+
+start is the start of the first SOF, end the end of the last one, first
+and last their frame numbers. starts (time from the previous SOF start),
+durations (end - start) and frames keep each SOF for expand().
+"""
+
+LineEventRun = collections.namedtuple("LineEventRun", "start end rxcmd count deltas")
+LineEventRun.__doc__ = """Consecutive LineEvents with the same RXCMD byte,
+deltas being the time from the previous one."""
+
+
+class _Run():
+    """A run being collapsed, its items stored as compact arrays."""
+    __slots__ = ("item", "start", "end", "count", "deltas", "durations", "frames", "open")
+
+    def __init__(self, item, start):
+        self.item = item
+        self.start = start
+        self.end = start
+        self.count = 1
+        self.deltas = None
+        self.open = True
+
+
+class IdleCollapser():
+    """Collapse the SOFs and repeated line events of a packet stream.
+
+    Takes the USBPackets and LineEvents of USBPacketDecoder and returns them
+    with runs of consecutive valid SOFs replaced by SOFRuns and runs of
+    LineEvents with the same RXCMD byte (e.g. the end of each SOF) replaced
+    by LineEventRuns. Both kinds of runs interleave: a run ends on any other
+    packet or line event, or after max_count items. Runs of a single item are
+    returned as is.
+
+    Each collapsed item takes 4 to 5 bytes instead of a namedtuple and its
+    data, and expand() gives back the original stream. Items are returned in
+    the order of their start, a run being returned once ended.
+    """
+    def __init__(self, max_count=65536):
+        self.max_count = max_count
+        self.queue = collections.deque()
+        self.sof = None
+        self.line = None
+        self.collapsed = 0
+
+    def _close(self):
+        for run in (self.sof, self.line):
+            if run is not None:
+                run.open = False
+        self.sof = self.line = None
+
+    def _sof(self, packet):
+        run = self.sof
+        if run is not None and run.count < self.max_count:
+            delta = packet.start - run.end
+            duration = packet.end - packet.start
+            if 0 <= delta < 2**16 and 0 <= duration < 2**8:
+                if run.deltas is None:
+                    # second SOF: start storing the run
+                    first = run.item
+                    run.deltas = array.array("H", [0])
+                    run.durations = array.array("B", [first.end - first.start])
+                    run.frames = array.array("H", [_frame(first)])
+                run.deltas.append(delta)
+                run.durations.append(duration)
+                run.frames.append(_frame(packet))
+                run.end = packet.start
+                run.count += 1
+                return True
+        return False
+
+    def _line(self, event):
+        run = self.line
+        if run is not None and run.count < self.max_count and run.item.rxcmd == event.rxcmd:
+            delta = event.timestamp - run.end
+            if 0 <= delta < 2**32:
+                if run.deltas is None:
+                    run.deltas = array.array("I", [0])
+                run.deltas.append(delta)
+                run.end = event.timestamp
+                run.count += 1
+                return True
+        return False
+
+    def decode(self, packets):
+        out = []
+        queue = self.queue
+        for packet in packets:
+            if type(packet) is LineEvent:
+                if self._line(packet):
+                    continue
+                if self.line is not None:
+                    self._close()
+                self.line = _Run(packet, packet.timestamp)
+                queue.append(self.line)
+            elif type(packet) is USBPacket and packet.pid == PID_SOF and packet.status == STATUS_OK:
+                if self._sof(packet):
+                    continue
+                if self.sof is not None:
+                    self._close()
+                self.sof = _Run(packet, packet.start)
+                queue.append(self.sof)
+            else:
+                self._close()
+                queue.append(packet)
+            self._emit(out)
+        self._emit(out)
+        return out
+
+    def _emit(self, out):
+        queue = self.queue
+        while queue:
+            item = queue[0]
+            if type(item) is _Run:
+                if item.open:
+                    break
+                item = self._collapse(item)
+            queue.popleft()
+            out.append(item)
+
+    def _collapse(self, run):
+        if run.count == 1:
+            return run.item
+        self.collapsed += run.count
+        if type(run.item) is LineEvent:
+            return LineEventRun(run.start, run.end, run.item.rxcmd, run.count, run.deltas)
+        frames = run.frames
+        return SOFRun(run.start, run.end + run.durations[-1], frames[0], frames[-1],
+                      run.count, run.deltas, run.durations, frames)
+
+    def flush(self):
+        """Return the runs in progress."""
+        self._close()
+        out = []
+        self._emit(out)
+        return out
+
+
+def _frame(packet):
+    return (packet.data[1] | (packet.data[2] << 8)) & 0x7ff
+
+
+def _start(item):
+    return item.timestamp if type(item) in (LineEvent, NAKRun) else item.start
+
+
+def _expand_run(run):
+    if type(run) is SOFRun:
+        ts = run.start
+        for delta, duration, frame in zip(run.starts, run.durations, run.frames):
+            ts += delta
+            yield USBPacket(ts, ts + duration, PID_SOF, encode_token(PID_SOF, frame), STATUS_OK)
+    elif type(run) is LineEventRun:
+        ts = run.start
+        for delta in run.deltas:
+            ts += delta
+            yield LineEvent(ts, run.rxcmd)
+    else:
+        yield run
+
+
+def expand(items):
+    """Yield the packets and line events of a stream returned by
+    IdleCollapser, runs expanded, in their original order."""
+    # runs overlap the items following them: merge the expanded runs, all
+    # the events before the start of an item being yielded before it
+    heap = []
+    i = 0
+    for item in itertools.chain(items, [None]):
+        start = float("inf") if item is None else _start(item)
+        while heap and heap[0][0] < start:
+            _, _, event, run = heap[0]
+            yield event
+            event = next(run, None)
+            if event is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (_start(event), i, event, run))
+                i += 1
+        if item is not None:
+            run = _expand_run(item)
+            heapq.heappush(heap, (start, i, next(run), run))
+            i += 1
+
+
+def collapse_idle(packets, collapser=None):
+    """Yield the items of a packet stream (see usb_packets()) with its idle
+    runs collapsed."""
+    if collapser is None:
+        collapser = IdleCollapser()
+    for packet in packets:
+        yield from collapser.decode([packet])
+    yield from collapser.flush()
+
+
+def format_item(item, clock=ITI_CLOCK):
+    if type(item) is SOFRun:
+        return "{:14.9f} SOF   frames {}-{} ({} SOFs)".format(
+            item.start/clock, item.first, item.last, item.count)
+    if type(item) is LineEventRun:
+        return "{:14.9f} RXCMD {:02x} linestate {} ({} times)".format(
+            item.start/clock, item.rxcmd, item.rxcmd & RXCMD_LINESTATE, item.count)
+    return format_packet(item, clock)
+
+
+def bench(n=200000):
+    import sys
+    import time
+    from usb_packets import encode_data, PID_IN, PID_DATA0, STATUS_CRC_ERROR
+
+    def packet(ts, data, status=STATUS_OK):
+        return USBPacket(ts, ts + len(data) + 2, data[0] & 0xf, data, status)
+
+    # idle high speed bus (a SOF and its end of packet RXCMD every 125 us,
+    # 8 microframes per frame), with some traffic and a corrupted SOF
+    stream = []
+    for i in range(n):
+        ts = 7500*i + i % 3
+        stream.append(packet(ts, encode_token(PID_SOF, (i//8) & 0x7ff)))
+        stream.append(LineEvent(ts + 8, 0x01))
+        if i % 10000 == 5000:
+            stream += [packet(ts + 100, encode_token(PID_IN, 0x81)),
+                       packet(ts + 110, encode_data(PID_DATA0, bytes(64))),
+                       packet(ts + 200, bytes([0xd2])),
+                       LineEvent(ts + 300, 0x02)]
+        if i % 10000 == 7000:
+            stream[-2] = stream[-2]._replace(status=STATUS_CRC_ERROR)
+
+    collapser = IdleCollapser()
+    collapsed = []
+    for i in range(0, len(stream), 4093):
+        collapsed += collapser.decode(stream[i:i + 4093])
+    collapsed += collapser.flush()
+    assert list(expand(collapsed)) == stream
+    assert collapser.collapsed > 0.99*2*n
+    starts = [_start(item) for item in collapsed]
+    assert starts == sorted(starts)
+
+    def size(items):
+        total = 0
+        for item in items:
+            total += sys.getsizeof(item)
+            for field in item:
+                if not isinstance(field, int):
+                    total += sys.getsizeof(field)
+        return total
+
+    start = time.perf_counter()
+    collapsed = IdleCollapser().decode(stream)
+    elapsed = time.perf_counter() - start
+    print("{} items, {:.0f} items/s, {} runs, {:.1f} MB -> {:.2f} MB".format(
+        len(stream), len(stream)/elapsed, len(collapsed), size(stream)/1e6, size(collapsed)/1e6))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,354 @@
+import collections
+
+from iti_decoder import (PAYLOAD_NONE, PAYLOAD_EVENT, PAYLOAD_DATA, PAYLOAD_RXCMD, EVENT_NAK_RUN,
+                         EVENT_LENGTHS, ITI_CLOCK)
+
+# PIDs
+PID_OUT   = 0x1
+PID_IN    = 0x9
+PID_SOF   = 0x5
+PID_SETUP = 0xd
+PID_DATA0 = 0x3
+PID_DATA1 = 0xb
+PID_DATA2 = 0x7
+PID_MDATA = 0xf
+PID_ACK   = 0x2
+PID_NAK   = 0xa
+PID_STALL = 0xe
+PID_NYET  = 0x6
+PID_PRE   = 0xc # ERR when used as a handshake
+PID_SPLIT = 0x8
+PID_PING  = 0x4
+
+PID_NAMES = {
+    PID_OUT:   "OUT",
+    PID_IN:    "IN",
+    PID_SOF:   "SOF",
+    PID_SETUP: "SETUP",
+    PID_DATA0: "DATA0",
+    PID_DATA1: "DATA1",
+    PID_DATA2: "DATA2",
+    PID_MDATA: "MDATA",
+    PID_ACK:   "ACK",
+    PID_NAK:   "NAK",
+    PID_STALL: "STALL",
+    PID_NYET:  "NYET",
+    PID_PRE:   "PRE",
+    PID_SPLIT: "SPLIT",
+    PID_PING:  "PING",
+}
+
+TOKEN_PIDS = {PID_OUT, PID_IN, PID_SOF, PID_SETUP, PID_PING}
+DATA_PIDS = {PID_DATA0, PID_DATA1, PID_DATA2, PID_MDATA}
+HANDSHAKE_PIDS = {PID_ACK, PID_NAK, PID_STALL, PID_NYET}
+
+# packet status
+STATUS_OK        = 0
+STATUS_PID_ERROR = 1 # PID check bits mismatch
+STATUS_CRC_ERROR = 2
+STATUS_LENGTH    = 3 # wrong length for the PID
+STATUS_RX_ERROR  = 4 # RxError reported by the PHY
+STATUS_TRUNCATED = 5 # capture started/stopped or overflowed during the packet
+
+STATUS_NAMES = ["OK", "PID_ERROR", "CRC_ERROR", "LENGTH", "RX_ERROR", "TRUNCATED"]
+
+# ULPI RXCMD byte
+RXCMD_LINESTATE = 0x03
+RXCMD_RXEVENT_SHIFT = 4
+RXEVENT_ACTIVE = 0b01
+RXEVENT_ERROR  = 0b11
+
+
+def _crc5(value, nbits):
+    crc = 0x1f
+    for i in range(nbits):
+        bit = (value >> i) & 1
+        crc = (crc >> 1) ^ 0x14 if (crc ^ bit) & 1 else crc >> 1
+    return crc ^ 0x1f
+
+
+def _crc16_byte(crc):
+    for i in range(8):
+        crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+
+# CRC5 of the 11 bits of token fields (address + endpoint, or frame number)
+crc5_table = [_crc5(value, 11) for value in range(2**11)]
+
+# CRC16 (data packets), reflected 0x8005, one byte at a time
+crc16_table = [_crc16_byte(i) for i in range(256)]
+
+# value of the CRC16 register after a packet and its valid CRC
+CRC16_RESIDUAL = 0xb001
+
+
+def crc16(data, crc=0xffff):
+    """Return the CRC16 register after data (without final inversion)."""
+    table = crc16_table
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc
+
+
+USBPacket = collections.namedtuple("USBPacket", "start end pid data status")
+USBPacket.__doc__ = """A packet seen on the bus.
+
+start and end are the timestamps of the first and last bytes (60 MHz
+ticks), pid the 4 bit PID (None if the packet is empty), data the bytes of
+the packet, PID byte and CRC included, and status one of STATUS_*.
+"""
+
+LineEvent = collections.namedtuple("LineEvent", "timestamp rxcmd")
+LineEvent.__doc__ = """An RXCMD received outside of a packet (line state
+changes, VBUS, ...). linestate = rxcmd & RXCMD_LINESTATE."""
+
+NAKRun = collections.namedtuple("NAKRun", "timestamp end count")
+NAKRun.__doc__ = """IN / NAK exchanges removed by the gateware (see
+gateware/compressor.py): the last exchange before timestamp was repeated
+count more times with the same token, the last repeat ending at end."""
+
+
+def check_packet(data):
+    """Return (pid, status) for the bytes of a packet."""
+    if not data:
+        return None, STATUS_LENGTH
+    pid = data[0] & 0xf
+    if (data[0] >> 4) != pid ^ 0xf:
+        return pid, STATUS_PID_ERROR
+    n = len(data)
+    if pid in TOKEN_PIDS:
+        if n != 3:
+            return pid, STATUS_LENGTH
+        value = data[1] | (data[2] << 8)
+        if crc5_table[value & 0x7ff] != value >> 11:
+            return pid, STATUS_CRC_ERROR
+    elif pid in DATA_PIDS:
+        if n < 3:
+            return pid, STATUS_LENGTH
+        if crc16(data[1:]) != CRC16_RESIDUAL:
+            return pid, STATUS_CRC_ERROR
+    elif pid == PID_SPLIT:
+        if n != 4:
+            return pid, STATUS_LENGTH
+        value = data[1] | (data[2] << 8) | (data[3] << 16)
+        if _crc5(value & 0x7ffff, 19) != value >> 19:
+            return pid, STATUS_CRC_ERROR
+    elif n != 1:
+        # handshakes / PRE
+        return pid, STATUS_LENGTH
+    return pid, STATUS_OK
+
+
+class USBPacketDecoder():
+    """Incremental reassembler of USB packets from ITI records.
+
+    Packets are delimited by the RxActive bit of the RXCMDs: the data
+    bytes received while RxActive is set form a packet, which ends on the
+    first RXCMD with RxActive cleared. A data byte received while no packet
+    is active also starts one, the PHY not always reporting the start of
+    reception with an RXCMD. RXCMDs outside packets are returned as
+    LineEvents if rxcmds is set. EVENT_NAK_RUN summaries are returned as
+    NAKRuns, after the packet they were received in if any, EVENT_TIME_SYNCs
+    are ignored (see iti_merge).
+
+    decode() takes the records of ITIDecoder.decode() and returns the
+    USBPackets and LineEvents completed by them; a packet still being
+    received is kept for the next call.
+    """
+    def __init__(self, rxcmds=True, check=True):
+        self.rxcmds = rxcmds
+        self.check = check
+        self.data = bytearray()
+        self.start = 0
+        self.end = 0
+        self.error = False
+        self.linestate = None
+        self.event = None
+        self.runs = []
+        self.packets = 0
+        self.errors = 0
+
+    def _packet(self, status=STATUS_OK):
+        data = bytes(self.data)
+        self.data.clear()
+        if self.error:
+            status = STATUS_RX_ERROR
+            self.error = False
+        if status == STATUS_OK and self.check:
+            pid, status = check_packet(data)
+        else:
+            pid = data[0] & 0xf
+        self.packets += 1
+        if status != STATUS_OK:
+            self.errors += 1
+        return USBPacket(self.start, self.end, pid, data, status)
+
+    def _event(self, ts, payload, out):
+        event = self.event
+        if event is None:
+            self.event = [ts, payload]
+            return
+        event.append(payload)
+        if len(event) < 2 + EVENT_LENGTHS[event[1]]:
+            return
+        self.event = None
+        if event[1] == EVENT_NAK_RUN:
+            delay = event[4] | (event[5] << 8) | (event[6] << 16)
+            run = NAKRun(event[0], event[0] - delay, event[2] | (event[3] << 8))
+            if self.data:
+                self.runs.append(run)
+            else:
+                out.append(run)
+
+    def decode(self, records):
+        out = []
+        append = out.append
+        data = self.data
+        for ts, payload_type, payload in records:
+            if payload_type == PAYLOAD_DATA:
+                if not data:
+                    self.start = ts
+                data.append(payload)
+                self.end = ts
+            elif payload_type == PAYLOAD_RXCMD:
+                self.linestate = payload & RXCMD_LINESTATE
+                rx_event = (payload >> RXCMD_RXEVENT_SHIFT) & 0b11
+                if rx_event == RXEVENT_ERROR:
+                    self.error = True
+                elif rx_event != RXEVENT_ACTIVE:
+                    if data:
+                        append(self._packet())
+                        if self.runs:
+                            out.extend(self.runs)
+                            self.runs.clear()
+                    if self.rxcmds:
+                        append(LineEvent(ts, payload))
+            elif payload_type == PAYLOAD_EVENT and (self.event is not None or payload in EVENT_LENGTHS):
+                self._event(ts, payload, out)
+            else:
+                # start/stop event or time overflow: the packet is incomplete.
+                # The bytes of a multi-byte event being received still follow
+                # (the gateware sends them in sequence), they are kept.
+                if data:
+                    append(self._packet(STATUS_TRUNCATED))
+                    out.extend(self.runs)
+                    self.runs.clear()
+        return out
+
+    def flush(self):
+        """Return the packet being received, if any, as truncated."""
+        if self.data:
+            out = [self._packet(STATUS_TRUNCATED)] + self.runs
+            self.runs.clear()
+            return out
+        return []
+
+
+def usb_packets(chunks, decoder=None):
+    """Yield the packets and line events of an iterable of lists of ITI
+    records (as returned by ITIDecoder.decode)."""
+    if decoder is None:
+        decoder = USBPacketDecoder()
+    for records in chunks:
+        yield from decoder.decode(records)
+    yield from decoder.flush()
+
+
+def format_packet(packet, clock=ITI_CLOCK):
+    if isinstance(packet, LineEvent):
+        return "{:14.9f} RXCMD {:02x} linestate {}".format(
+            packet.timestamp/clock, packet.rxcmd, packet.rxcmd & RXCMD_LINESTATE)
+    if isinstance(packet, NAKRun):
+        return "{:14.9f} IN/NAK repeated {} times until {:.9f}".format(
+            packet.timestamp/clock, packet.count, packet.end/clock)
+    r = "{:14.9f} {:5s}".format(packet.start/clock, PID_NAMES.get(packet.pid, "?"))
+    if packet.pid in TOKEN_PIDS and packet.status == STATUS_OK:
+        value = packet.data[1] | (packet.data[2] << 8)
+        if packet.pid == PID_SOF:
+            r += " frame {}".format(value & 0x7ff)
+        else:
+            r += " addr {} endp {}".format(value & 0x7f, (value >> 7) & 0xf)
+    elif packet.pid in DATA_PIDS:
+        r += " " + packet.data[1:-2].hex()
+    if packet.status != STATUS_OK:
+        r += " [{}]".format(STATUS_NAMES[packet.status])
+    return r
+
+
+def encode_token(pid, value):
+    """Return the bytes of a token packet (for testing)."""
+    value |= crc5_table[value & 0x7ff] << 11
+    return bytes([pid | ((pid ^ 0xf) << 4), value & 0xff, value >> 8])
+
+
+def encode_data(pid, payload):
+    """Return the bytes of a data packet (for testing)."""
+    crc = crc16(payload) ^ 0xffff
+    return bytes([pid | ((pid ^ 0xf) << 4)]) + payload + crc.to_bytes(2, "little")
+
+
+def bench(n=100000):
+    import time
+
+    # known packets
+    assert encode_token(PID_SETUP, 0) == bytes([0x2d, 0x00, 0x10])
+    get_descriptor = bytes([0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])
+    assert encode_data(PID_DATA0, get_descriptor)[-2:] == bytes([0xdd, 0x94])
+
+    rx_active = RXEVENT_ACTIVE << RXCMD_RXEVENT_SHIFT
+    def records(packet, ts):
+        r = [(ts, PAYLOAD_RXCMD, rx_active)]
+        for i, b in enumerate(packet):
+            r.append((ts + 1 + i, PAYLOAD_DATA, b))
+        r.append((ts + 1 + len(packet), PAYLOAD_RXCMD, 0))
+        return r
+
+    transaction = [
+        encode_token(PID_SETUP, 0),
+        encode_data(PID_DATA0, get_descriptor),
+        bytes([0xd2]),
+        encode_token(PID_SOF, 0x123),
+        encode_token(PID_IN, 0x85)[:2] + b"\x00", # bad CRC
+    ]
+    stream = []
+    for i in range(n//len(transaction)):
+        for packet in transaction:
+            stream += records(packet, 100*len(stream))
+
+    decoder = USBPacketDecoder(rxcmds=False)
+    count = sum(len(packet) + 2 for packet in transaction)
+    packets = decoder.decode(stream[:7]) + decoder.decode(stream[7:count])
+    assert [p.data for p in packets] == transaction
+    assert [p.status for p in packets] == [STATUS_OK]*4 + [STATUS_CRC_ERROR]
+    assert [p.pid for p in packets] == [PID_SETUP, PID_DATA0, PID_ACK, PID_SOF, PID_IN]
+
+    # NAK run summary received in the middle of a packet
+    summary = [(1000 + i, PAYLOAD_EVENT, b) for i, b in enumerate([EVENT_NAK_RUN, 3, 0, 100, 0, 0])]
+    packet = records(encode_data(PID_DATA1, bytes([1, 2])), 990)
+    decoder = USBPacketDecoder(rxcmds=False)
+    packets = decoder.decode(packet[:3] + summary + packet[3:])
+    assert [type(p) for p in packets] == [USBPacket, NAKRun]
+    assert packets[0].status == STATUS_OK and packets[1] == NAKRun(1000, 900, 3)
+
+    # summary interrupted by a time overflow record: the following bytes
+    # complete it, they do not end the next packet
+    overflow = (1002, PAYLOAD_NONE, None)
+    packet = records(encode_data(PID_DATA1, bytes([1, 2])), 1010)
+    decoder = USBPacketDecoder(rxcmds=False)
+    packets = decoder.decode(summary[:2] + [overflow] + summary[2:4])
+    packets += decoder.decode(packet[:3] + summary[4:] + packet[3:])
+    assert [type(p) for p in packets] == [USBPacket, NAKRun]
+    assert packets[0].status == STATUS_OK and packets[0].data == encode_data(PID_DATA1, bytes([1, 2]))
+    assert packets[1] == NAKRun(1000, 900, 3)
+
+    decoder = USBPacketDecoder(rxcmds=False)
+    start = time.perf_counter()
+    packets = decoder.decode(stream)
+    elapsed = time.perf_counter() - start
+    print("{} packets, {:.0f} packets/s, {:.2f} M records/s".format(
+        len(packets), len(packets)/elapsed, len(stream)/elapsed/1e6))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,319 @@
+import pickle
+import collections
+
+from usb_packets import (USBPacket, LineEvent, NAKRun, STATUS_OK, TOKEN_PIDS, DATA_PIDS,
+                         PID_SOF, PID_SETUP, PID_IN, PID_OUT, PID_PING,
+                         PID_DATA0, PID_DATA1, PID_ACK, PID_NAK, PID_STALL)
+
+# transfer kinds
+KIND_CONTROL     = 0
+KIND_BULK        = 1 # or interrupt, they look the same on the bus
+KIND_ISOCHRONOUS = 2
+
+KIND_NAMES = ["CONTROL", "BULK", "ISOCHRONOUS"]
+
+# transfer status
+TRANSFER_OK      = 0
+TRANSFER_STALL   = 1
+TRANSFER_ERROR   = 2 # a packet of the transfer was corrupted
+TRANSFER_ABORTED = 3 # control transfer interrupted by a new SETUP
+TRANSFER_PARTIAL = 4 # data split to bound memory, the transfer continues
+
+TRANSFER_STATUS_NAMES = ["OK", "STALL", "ERROR", "ABORTED", "PARTIAL"]
+
+# control transfer stages
+STAGE_DATA   = 0
+STAGE_STATUS = 1
+
+# possible wMaxPacketSize of full/high speed bulk/interrupt/control endpoints
+MAX_PACKET_SIZES = {8, 16, 32, 64, 512, 1024}
+
+
+Transaction = collections.namedtuple("Transaction",
+    "start end token addr endp data_pid data handshake status")
+Transaction.__doc__ = """A token, its data packet and handshake (if any).
+
+data is the payload of the data packet (PID and CRC removed) or None,
+handshake the PID of the handshake or None (isochronous, timeout), status
+the status of the first corrupted packet or STATUS_OK.
+"""
+
+Transfer = collections.namedtuple("Transfer",
+    "start end addr endp kind direction setup data status")
+Transfer.__doc__ = """A control, bulk/interrupt or isochronous transfer.
+
+direction is PID_IN or PID_OUT, setup the 8 bytes of the SETUP stage of
+control transfers (None otherwise) and data the payload of the data stage.
+"""
+
+
+class TransactionDecoder():
+    """Group USBPackets into transactions.
+
+    A transaction starts on a token and ends on its handshake. Without a
+    handshake (isochronous, or a timeout), it ends on the next token or
+    SOF. Packets outside a transaction are counted in orphans.
+    """
+    def __init__(self):
+        self.pending = None # [start, end, token, addr, endp, data_pid, data, status]
+        self.frame = None
+        self.orphans = 0
+
+    def _finish(self, out, handshake=None):
+        start, end, token, addr, endp, data_pid, data, status = self.pending
+        self.pending = None
+        out.append(Transaction(start, end, token, addr, endp, data_pid, data, handshake, status))
+
+    def decode(self, packets):
+        out = []
+        for packet in packets:
+            if isinstance(packet, (LineEvent, NAKRun)):
+                continue
+            pid = packet.pid
+            if pid in TOKEN_PIDS:
+                if self.pending is not None:
+                    self._finish(out)
+                if packet.status != STATUS_OK:
+                    self.orphans += 1
+                    continue
+                value = packet.data[1] | (packet.data[2] << 8)
+                if pid == PID_SOF:
+                    self.frame = value & 0x7ff
+                    continue
+                self.pending = [packet.start, packet.end, pid, value & 0x7f, (value >> 7) & 0xf,
+                                None, None, STATUS_OK]
+            elif self.pending is None:
+                self.orphans += 1
+            elif pid in DATA_PIDS and self.pending[5] is None:
+                self.pending[1] = packet.end
+                self.pending[5] = pid
+                self.pending[6] = packet.data[1:-2]
+                if packet.status != STATUS_OK:
+                    self.pending[7] = packet.status
+            else:
+                # handshake
+                self.pending[1] = packet.end
+                if packet.status != STATUS_OK and self.pending[7] == STATUS_OK:
+                    self.pending[7] = packet.status
+                self._finish(out, pid)
+        return out
+
+
+class EndpointState():
+    """Transfer in progress on an endpoint."""
+    __slots__ = ("kind", "direction", "stage", "setup", "length", "data",
+                 "start", "end", "status", "active", "toggle", "max_packet", "naks")
+
+    def __init__(self):
+        self.active = False
+        self.toggle = None
+        self.max_packet = 0
+        self.naks = 0
+
+    def begin(self, t, kind, direction):
+        self.active = True
+        self.kind = kind
+        self.direction = direction
+        self.stage = STAGE_DATA
+        self.setup = None
+        self.length = None
+        self.data = bytearray()
+        self.start = t.start
+        self.end = t.end
+        self.status = TRANSFER_OK
+
+
+class TransferDecoder():
+    """Aggregate transactions into transfers per (address, endpoint).
+
+    Control transfers go through their SETUP, data and status stages. Bulk
+    and interrupt transfers are made of consecutive ACKed data packets in
+    the same direction until a short (or zero length) packet. The maximum
+    packet size is learned from the packets seen. NAKed transactions and
+    retransmissions (same data toggle) are skipped, NAKs being counted per
+    endpoint. Isochronous transactions are transfers of their own.
+
+    The data of a transfer is bounded: past max_transfer bytes it is
+    returned as a TRANSFER_PARTIAL transfer and accumulation starts over.
+    """
+    def __init__(self, max_transfer=64*1024):
+        self.max_transfer = max_transfer
+        self.endpoints = {}
+
+    def _finish(self, out, key, ep, status=None):
+        if status is not None:
+            ep.status = status
+        out.append(Transfer(ep.start, ep.end, key[0], key[1], ep.kind, ep.direction,
+                            ep.setup, bytes(ep.data), ep.status))
+        ep.active = False
+        ep.data = None
+
+    def _control(self, out, key, ep, t, data):
+        if ep.stage == STAGE_DATA and ep.length:
+            ep.data += data
+            if len(ep.data) >= ep.length or len(data) < ep.max_packet:
+                ep.stage = STAGE_STATUS
+        else:
+            # status stage of a transfer without data stage (always IN)
+            self._finish(out, key, ep)
+
+    def _bulk(self, out, key, ep, t, data):
+        if not ep.active:
+            ep.begin(t, KIND_BULK, t.token)
+        ep.data += data
+        n = len(data)
+        if n in MAX_PACKET_SIZES and n >= ep.max_packet:
+            ep.max_packet = n
+        else:
+            # short packet
+            self._finish(out, key, ep)
+
+    def decode(self, transactions):
+        out = []
+        endpoints = self.endpoints
+        for t in transactions:
+            if t.token == PID_PING:
+                continue
+            # control endpoints are bidirectional, keyed by (address,
+            # endpoint), other endpoints by (address, endpoint, direction)
+            key = (t.addr, t.endp)
+            ep = endpoints.get(key)
+            control = t.token == PID_SETUP or (ep is not None and ep.active)
+            if not control:
+                key = (t.addr, t.endp, t.token)
+                ep = endpoints.get(key)
+            if ep is None:
+                ep = endpoints[key] = EndpointState()
+
+            if t.status != STATUS_OK:
+                if ep.active:
+                    ep.end = t.end
+                    self._finish(out, key, ep, TRANSFER_ERROR)
+                continue
+
+            if t.token == PID_SETUP:
+                if t.handshake != PID_ACK or t.data is None or len(t.data) != 8:
+                    continue
+                if ep.active:
+                    self._finish(out, key, ep, TRANSFER_ABORTED)
+                setup = t.data
+                ep.begin(t, KIND_CONTROL, PID_IN if setup[0] & 0x80 else PID_OUT)
+                ep.setup = setup
+                ep.length = setup[6] | (setup[7] << 8)
+                ep.toggle = PID_DATA0
+                if ep.max_packet == 0:
+                    ep.max_packet = 8
+                continue
+
+            if t.handshake == PID_NAK:
+                ep.naks += 1
+                continue
+            if t.handshake == PID_STALL:
+                if not ep.active:
+                    ep.begin(t, KIND_BULK, t.token)
+                ep.end = t.end
+                self._finish(out, key, ep, TRANSFER_STALL)
+                continue
+            if t.data is None:
+                continue
+            if t.handshake is None:
+                out.append(Transfer(t.start, t.end, t.addr, t.endp, KIND_ISOCHRONOUS,
+                                    t.token, None, t.data, TRANSFER_OK))
+                continue
+
+            # ACKed (or NYET) data
+            if control and t.token != ep.direction:
+                # status stage, always DATA1
+                ep.end = t.end
+                self._finish(out, key, ep)
+                continue
+            if t.data_pid == ep.toggle:
+                # retransmission of the last data packet
+                continue
+            ep.toggle = t.data_pid
+            if control:
+                ep.end = t.end
+                self._control(out, key, ep, t, t.data)
+            else:
+                self._bulk(out, key, ep, t, t.data)
+
+            if ep.active and len(ep.data) >= self.max_transfer:
+                self._finish(out, key, ep, TRANSFER_PARTIAL)
+                ep.active = True
+                ep.data = bytearray()
+                ep.start = t.end
+                ep.status = TRANSFER_OK
+        return out
+
+
+def checkpoint(*decoders):
+    """Return the state of decoders as bytes, to resume decoding later."""
+    return pickle.dumps(decoders)
+
+
+def restore(state):
+    """Return the decoders saved by checkpoint()."""
+    return pickle.loads(state)
+
+
+def bench(n=20000):
+    import time
+    from usb_packets import encode_token, encode_data
+
+    def packets(ts, *datas):
+        return [USBPacket(ts + i, ts + i, data[0] & 0xf, data, STATUS_OK)
+                for i, data in enumerate(datas)]
+
+    ack = bytes([0xd2])
+    nak = bytes([0x5a])
+    get_descriptor = bytes([0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x12, 0x00])
+    descriptor = bytes(range(18))
+    token = lambda pid, addr, endp: encode_token(pid, addr | (endp << 7))
+
+    stream = []
+    for i in range(n):
+        ts = 1000*i
+        stream += packets(ts,
+            encode_token(PID_SOF, i & 0x7ff),
+            # control read of 18 bytes: SETUP, IN 8 + 8 + 2, OUT ZLP
+            token(PID_SETUP, 1, 0), encode_data(PID_DATA0, get_descriptor), ack,
+            token(PID_IN, 1, 0), nak,
+            token(PID_IN, 1, 0), encode_data(PID_DATA1, descriptor[0:8]), ack,
+            token(PID_IN, 1, 0), encode_data(PID_DATA0, descriptor[8:16]), ack,
+            token(PID_IN, 1, 0), encode_data(PID_DATA1, descriptor[16:18]), ack,
+            token(PID_OUT, 1, 0), encode_data(PID_DATA1, b""), ack,
+            # bulk OUT of 512 + 100 bytes on endpoint 2, retransmitting the first packet
+            token(PID_OUT, 1, 2), encode_data(PID_DATA0, bytes(512)), ack,
+            token(PID_OUT, 1, 2), encode_data(PID_DATA0, bytes(512)), ack,
+            token(PID_OUT, 1, 2), encode_data(PID_DATA1, bytes(100)), nak,
+            token(PID_OUT, 1, 2), encode_data(PID_DATA1, bytes(100)), ack,
+            # a zero length IN on endpoint 2 is a transfer of its own
+            token(PID_IN, 1, 2), encode_data([PID_DATA0, PID_DATA1][i % 2], b""), ack)
+
+    transactions = TransactionDecoder()
+    transfers = TransferDecoder()
+    split = len(stream)//2
+    first = transfers.decode(transactions.decode(stream[:split]))
+    # resume the second half from a checkpoint
+    transactions, transfers = restore(checkpoint(transactions, transfers))
+    result = first + transfers.decode(transactions.decode(stream[split:]))
+
+    control = [t for t in result if t.kind == KIND_CONTROL]
+    bulk = [t for t in result if t.kind == KIND_BULK]
+    assert len(control) == n and len(bulk) == 2*n
+    assert all(t.data == descriptor and t.setup == get_descriptor and
+               t.direction == PID_IN and t.status == TRANSFER_OK for t in control)
+    assert all(len(t.data) == 612 for t in bulk if t.direction == PID_OUT)
+    assert all(len(t.data) == 0 for t in bulk if t.direction == PID_IN)
+    assert transfers.endpoints[(1, 0)].naks == n
+    assert transfers.endpoints[(1, 2, PID_OUT)].naks == n
+
+    start = time.perf_counter()
+    result = TransferDecoder().decode(TransactionDecoder().decode(stream))
+    elapsed = time.perf_counter() - start
+    print("{} packets, {:.0f} packets/s, {} transfers".format(
+        len(stream), len(stream)/elapsed, len(result)))
+
+
+if __name__ == "__main__":
+    bench()
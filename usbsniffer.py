@@ -24,13 +24,15 @@ from litedram.phy import a7ddrphy
 from gateware.usb import USBCore
 from gateware.etherbone import Etherbone
 from gateware.ft601 import FT601Sync, phy_description
-from gateware.ulpi import ULPIPHY, ULPICore, ulpi_cmd_description
-from gateware.iti import ITICore, Conv4032
+from gateware.ulpi import ULPIPHY, ULPICore, ULPIFilter, ULPIAddressFilter, ulpi_cmd_description
+from gateware.iti import ITITimebase, ITICore, Conv4032
 from gateware.wrapper import WrapCore
 from gateware.dramfifo import LiteDRAMFIFO
 from gateware.spi import SPIMaster
 from gateware.flash import Flash
 from gateware.storage import OverflowMeter
+from gateware.trigger import Trigger
+from gateware.compressor import NAKCompressor
 
 from litescope import LiteScopeAnalyzer
 
@@ -290,10 +292,19 @@ class USBSnifferSoC(SoCSDRAM):
         "ulpi_phy1",
         "ulpi_core0",
         "ulpi_core1",
+        "ulpi_filter0",
+        "ulpi_filter1",
+        "ulpi_address_filter0",
+        "ulpi_address_filter1",
+        "nak_compressor0",
+        "nak_compressor1",
+        "trigger0",
+        "trigger1",
         "overflow0",
         "overflow1",
         "ulpi_sw_oe_n",
         "ulpi_sw_s",
+        "timebase",
         "iticore0",
         "iticore1",
         "blinker0",
@@ -333,12 +344,17 @@ class USBSnifferSoC(SoCSDRAM):
                             sdram_module.geom_settings,
                             sdram_module.timing_settings)
 
-        # sdram fifo
+        # sdram fifos, one region per ulpi channel, the crossbar arbitrates
+        # their ports in round robin
         depth = 32 * 1024 * 1024
+        base = depth // (self.sdram.crossbar.controller.data_width // 32)
         self.submodules.dramfifo = ResetInserter()(LiteDRAMFIFO([("data", 32)], depth, 0,
                                             self.sdram.crossbar, preserve_first_last=False))
+        self.submodules.dramfifo1 = ResetInserter()(LiteDRAMFIFO([("data", 32)], depth, base,
+                                            self.sdram.crossbar, preserve_first_last=False))
 
         self.submodules.hugefifo = ResetInserter()(stream.SyncFIFO([("data", 32)], 512))
+        self.submodules.hugefifo1 = ResetInserter()(stream.SyncFIFO([("data", 32)], 512))
 
         # debug wishbone
         self.add_cpu(UARTWishboneBridge(platform.request("serial"), clk_freq, baudrate=3e6))
@@ -367,13 +383,20 @@ class USBSnifferSoC(SoCSDRAM):
             self.submodules.ulpi_sw_oe_n = GPIOOut(ulpi_sw.oe_n)
             self.submodules.ulpi_sw_s = GPIOOut(ulpi_sw.s)
 
+            # time shared by the iti cores
+            self.submodules.timebase = ITITimebase()
+
             # ulpi 0
             self.submodules.ulpi_phy0 = ULPIPHY(platform.request("ulpi", 0), cd="ulpi0")
             self.submodules.ulpi_core0 = ULPICore(self.ulpi_phy0)
 
             # packer0
+            self.submodules.ulpi_filter0 = ULPIFilter()
+            self.submodules.ulpi_address_filter0 = ULPIAddressFilter()
+            self.submodules.nak_compressor0 = NAKCompressor(self.timebase.tick)
+            self.submodules.trigger0 = Trigger(self.dramfifo.level)
             self.submodules.overflow0 = OverflowMeter(ulpi_cmd_description(8, 1))
-            self.submodules.iticore0 = ITICore()
+            self.submodules.iticore0 = ITICore(self.timebase)
             self.submodules.fifo0 = ResetInserter()(stream.SyncFIFO([("data", 40), ("len", 2)], 16))
             self.submodules.conv40320 = Conv4032()
 
@@ -381,22 +404,61 @@ class USBSnifferSoC(SoCSDRAM):
             self.submodules.ulpi_phy1 = ULPIPHY(platform.request("ulpi", 1), cd="ulpi1")
             self.submodules.ulpi_core1 = ULPICore(self.ulpi_phy1)
 
+            # packer1
+            self.submodules.ulpi_filter1 = ULPIFilter()
+            self.submodules.ulpi_address_filter1 = ULPIAddressFilter()
+            self.submodules.nak_compressor1 = NAKCompressor(self.timebase.tick)
+            self.submodules.trigger1 = Trigger(self.dramfifo1.level)
+            self.submodules.overflow1 = OverflowMeter(ulpi_cmd_description(8, 1))
+            self.submodules.iticore1 = ITICore(self.timebase)
+            self.submodules.fifo1 = ResetInserter()(stream.SyncFIFO([("data", 40), ("len", 2)], 16))
+            self.submodules.conv40321 = Conv4032()
+
             # usb <--> ulpi0
             self.submodules.wrapcore0 = WrapCore(self.usb_core, self.usb_map["ulpi0"])
             self.comb += [
-                self.ulpi_core0.source.connect(self.overflow0.sink),
+                self.ulpi_core0.source.connect(self.ulpi_filter0.sink),
+                self.ulpi_filter0.source.connect(self.ulpi_address_filter0.sink),
+                self.ulpi_address_filter0.source.connect(self.nak_compressor0.sink),
+                self.nak_compressor0.source.connect(self.trigger0.sink),
+                self.trigger0.source.connect(self.overflow0.sink),
                 self.overflow0.source.connect(self.iticore0.sink),
                 self.iticore0.source.connect(self.fifo0.sink),
                 self.fifo0.source.connect(self.conv40320.sink),
                 self.conv40320.source.connect(self.hugefifo.sink),
                 self.hugefifo.source.connect(self.dramfifo.sink),
-                self.dramfifo.source.connect(self.wrapcore0.sink),
+                self.dramfifo.source.connect(self.trigger0.gate.sink),
+                self.trigger0.gate.source.connect(self.wrapcore0.sink),
+                self.iticore0.trigger.eq(self.trigger0.trigger),
+                self.nak_compressor0.event_source.connect(self.iticore0.event_sink),
+            ]
+
+            # usb <--> ulpi1
+            self.submodules.wrapcore1 = WrapCore(self.usb_core, self.usb_map["ulpi1"])
+            self.comb += [
+                self.ulpi_core1.source.connect(self.ulpi_filter1.sink),
+                self.ulpi_filter1.source.connect(self.ulpi_address_filter1.sink),
+                self.ulpi_address_filter1.source.connect(self.nak_compressor1.sink),
+                self.nak_compressor1.source.connect(self.trigger1.sink),
+                self.trigger1.source.connect(self.overflow1.sink),
+                self.overflow1.source.connect(self.iticore1.sink),
+                self.iticore1.source.connect(self.fifo1.sink),
+                self.fifo1.source.connect(self.conv40321.sink),
+                self.conv40321.source.connect(self.hugefifo1.sink),
+                self.hugefifo1.source.connect(self.dramfifo1.sink),
+                self.dramfifo1.source.connect(self.trigger1.gate.sink),
+                self.trigger1.gate.source.connect(self.wrapcore1.sink),
+                self.iticore1.trigger.eq(self.trigger1.trigger),
+                self.nak_compressor1.event_source.connect(self.iticore1.event_sink),
             ]
 
             # reset manager
             self.rst_manager = ResetManager([self.iticore0, self.fifo0,
                                              self.conv40320, self.hugefifo,
-                                             self.dramfifo, self.wrapcore0])
+                                             self.dramfifo, self.wrapcore0,
+                                             self.iticore1, self.fifo1,
+                                             self.conv40321, self.hugefifo1,
+                                             self.dramfifo1, self.wrapcore1])
 
             # leds
             led0 = platform.request("rgb_led", 0)